@@ -0,0 +1,38 @@
+# Clipping of features by boundary polygons (Hartford, CT without WestCOG)
+# Boundaries are merged into one geometry and prepared (GEOS builds an index of its edges),
+# so point in polygon test does not walk the whole boundary for every point.
+
+import geopandas as gpd
+import pandas as pd
+import shapely
+
+
+def load_boundary(path):
+    """
+    Reads boundary file and merges all its polygons into one prepared geometry.
+
+    :Returns Type:
+      shapely geometry
+    """
+    boundary = gpd.read_file(path)
+    boundary = shapely.union_all(boundary.geometry.values)
+    shapely.prepare(boundary)
+    return boundary
+
+
+def within_boundaries(x, y, boundaries):
+    """
+    Tests points against several named boundaries in one pass over the points.
+    Same as within(): points on the boundary line are outside.
+
+    :Parameters:
+      - `x, y: coordinates of points (numpy arrays), e.g. centroids of buildings
+      - `boundaries: dictionary {name: prepared geometry}, see load_boundary()
+
+    :Returns:
+      - inside: one boolean column per boundary name, one row per point
+
+    :Returns Type:
+      DataFrame
+    """
+    return pd.DataFrame({name: shapely.contains_xy(boundary, x, y) for name, boundary in boundaries.items()})
@@ -0,0 +1,149 @@
+# Fill missing zip codes (addr:postcode) and town names (addr:city) of addresses by point in polygon lookup.
+# Python version of Fill_zipCodes_townNames.R that works on any address dataset: OSM addresses from a local extract
+# (see osm_extract.py) or output stage of process_CT_address.py.
+# Zip code areas (ZCTA) and town boundaries are put into one spatial index and looked up in one pass,
+# polygons are prepared, so each point in polygon test uses an index of polygon edges.
+# Valid polygon layers are cached on disk, existing values are never overwritten.
+#
+# Usage: python fill_zip_town.py [--stage /Buildigns_footprints_testing/Address/CTAddressDedup-parsed]
+
+import geopandas as gpd
+import pandas as pd
+import numpy as np
+import shapely
+import os
+import re
+import time
+import argparse
+from osm_extract import cached, source_key, load_addresses, load_towns
+from storage import save_stage, load_stage
+
+
+ZIP_AREAS = os.path.expanduser("~/Desktop/Buildings/NAD_address/NAD_r6_TXT/TXT/Zip Code Tabulation Area Boundaries.geojson")
+OSM_EXTRACT = os.path.expanduser("~/Desktop/Buildings/OSM/connecticut-latest.osm.pbf")
+OUTPUT = os.path.expanduser("~/Desktop/Buildings/NAD_address/NAD_r6_TXT/TXT/filled_zipCode_townName.geojson")
+
+
+def load_lookup_layers(zipAreas = ZIP_AREAS, towns = OSM_EXTRACT, crs = "EPSG:4326"):
+    """
+    Loads zip code areas (column zcta5ce10) and town boundaries (admin_level 8) as one polygon layer.
+    Polygons are made valid and transformed to crs. Result is cached for the same sources and crs.
+    Without towns only zip code areas are loaded.
+
+    :Returns:
+      - layers: columns tag (OSM tag the polygon fills), value, geometry
+
+    :Returns Type:
+      GeoDataFrame
+    """
+    def build():
+        zips = gpd.read_file(zipAreas)[['zcta5ce10', 'geometry']].rename(columns={'zcta5ce10': 'value'})
+        zips['tag'] = 'addr:postcode'
+        parts = [zips.to_crs(crs)]
+        if towns is not None:
+            townNames = load_towns(towns).rename(columns={'town_name': 'value'})
+            townNames['tag'] = 'addr:city'
+            parts.append(townNames.to_crs(crs))
+        layers = pd.concat(parts, ignore_index=True).pipe(gpd.GeoDataFrame)
+        layers['geometry'] = shapely.make_valid(layers.geometry.values)
+        return layers[['tag', 'value', 'geometry']]
+
+    sources = [zipAreas] if towns is None else [zipAreas, towns]
+    return cached('lookup-layers-' + re.sub('[^0-9A-Za-z]', '', str(crs)), source_key(*sources), build)
+
+
+def lookup_points(layers, x, y):
+    """
+    Finds polygons of all layers that contain the points (boundary included, as st_intersects).
+    Candidates are found by bounding boxes in one STRtree query, then tested against prepared polygons.
+
+    :Parameters:
+      - `layers: polygons from load_lookup_layers()
+      - `x, y: coordinates of points (numpy arrays)
+
+    :Returns:
+      - pointIdx, polygonIdx: arrays of matching pairs, sorted by point and polygon
+
+    :Returns Type:
+      tuple
+    """
+    polygons = np.asarray(layers.geometry.values, dtype=object)
+    shapely.prepare(polygons)
+    tree = shapely.STRtree(polygons)
+    pointIdx, polygonIdx = tree.query(shapely.points(x, y))
+    hit = shapely.intersects_xy(polygons[polygonIdx], x[pointIdx], y[pointIdx])
+    pointIdx, polygonIdx = pointIdx[hit], polygonIdx[hit]
+    order = np.lexsort((polygonIdx, pointIdx))
+    return pointIdx[order], polygonIdx[order]
+
+
+def fill_missing(addresses, layers, fills = None):
+    """
+    Fills missing values of tags in layers (addr:postcode, addr:city) from the polygon the address lies in.
+    Polygons and multipolygons are looked up by centroid of their valid geometry, geometry itself is not changed.
+    Only rows with at least one missing tag are looked up. When address lies in more polygons of one layer
+    (e.g. on the border of two towns) the first polygon is used, so rows are never duplicated.
+
+    :Parameters:
+      - `addresses: GeoDataFrame with address tags
+      - `layers: polygons from load_lookup_layers() in CRS of addresses
+      - `fills: optional dictionary, number of filled values of each tag is added to it
+
+    :Returns:
+      - addresses with filled tags
+
+    :Returns Type:
+      GeoDataFrame
+    """
+    addresses = addresses.copy()
+    tags = list(layers['tag'].unique())
+    for tag in tags:
+        if tag not in addresses.columns:
+            addresses[tag] = None
+    missing = addresses[tags].isnull().to_numpy()
+    rows = np.flatnonzero(missing.any(axis=1))
+
+    geometry = np.asarray(addresses.geometry.values[rows], dtype=object)
+    notPoint = shapely.get_type_id(geometry) != 0
+    geometry[notPoint] = shapely.centroid(shapely.make_valid(geometry[notPoint]))
+    pointIdx, polygonIdx = lookup_points(layers, shapely.get_x(geometry), shapely.get_y(geometry))
+
+    polygonTag = layers['tag'].to_numpy(dtype=object)
+    polygonValue = layers['value'].to_numpy(dtype=object)
+    for i, tag in enumerate(tags):
+        layer = polygonTag[polygonIdx] == tag
+        value = np.full(len(rows), None, dtype=object)
+        # Reversed so that the first matching polygon of a point is written last
+        value[pointIdx[layer][::-1]] = polygonValue[polygonIdx[layer][::-1]]
+        fill = missing[rows, i] & pd.notnull(value)
+        addresses.iloc[rows[fill], addresses.columns.get_loc(tag)] = value[fill]
+        if fills is not None:
+            fills[tag] = fills.get(tag, 0) + int(fill.sum())
+    return addresses
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill missing zip codes and town names of addresses")
+    parser.add_argument('--stage', default=None, help="address stage to fill (see storage.py), default: OSM addresses without zip code")
+    parser.add_argument('--zip-areas', default=ZIP_AREAS)
+    parser.add_argument('--osm', default=OSM_EXTRACT, help="OSM extract with town boundaries (and addresses)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.stage is None:
+        addresses = load_addresses(args.osm)
+        addresses = addresses.loc[addresses['addr:postcode'].isnull()].drop(columns=['osm_id'])
+    else:
+        addresses = load_stage(args.stage)
+    layers = load_lookup_layers(args.zip_areas, args.osm, addresses.crs)
+
+    fills = {}
+    addresses = fill_missing(addresses, layers, fills)
+    for tag, n in fills.items():
+        print("Filled " + tag + ": " + str(n))
+    print("Filled " + str(len(addresses)) + " addresses in " + str(round(time.perf_counter() - start, 2)) + " s")
+
+    if args.stage is None:
+        addresses.to_file(OUTPUT, driver='GeoJSON')
+    else:
+        save_stage(addresses, args.stage + '-filled')
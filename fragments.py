@@ -0,0 +1,215 @@
+# Splitting of final dataset into import fragments (grid cells)
+# Every feature is assigned to its cell in one pass and fragments are written from one groupby,
+# so the cost does not grow with number of cells.
+# Grid is adaptive (quadtree_grid): cells are split until they hold at most a given number of features.
+# Fragments are serialized to GeoJSON concurrently on all CPU cores (write_fragments).
+
+import geopandas as gpd
+import shapely
+import numpy as np
+import os
+import time
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+def split_fragments(features, cell):
+    """
+    Splits features into fragments by their cell.
+
+    :Parameters:
+      - `features: GeoDataFrame
+      - `cell: cell position of every feature (see quadtree_grid). Features with -1 are skipped.
+
+    :Returns:
+      Generator of (cell position, GeoDataFrame) in order of cells. Only non-empty cells are returned.
+      Features keep their original order.
+
+    :Returns Type:
+      generator
+    """
+    for i, fragment in features.groupby(cell, sort=True):
+        if i < 0:
+            continue
+        yield int(i), fragment
+
+
+def grid_position(x, y, bounds, cols, rows):
+    """
+    Position of points in regular grid computed directly from coordinates: floor((x - xmin) / width).
+    Points on the right/top border of bounds belong to the last column/row.
+
+    :Parameters:
+      - `x, y: coordinates of points (numpy arrays)
+      - `bounds: (xmin, ymin, xmax, ymax) of the grid
+      - `cols, rows: number of grid columns and rows
+
+    :Returns:
+      - position: row * cols + col for every point (row 0 at the bottom), -1 for points outside bounds
+
+    :Returns Type:
+      numpy array
+    """
+    xmin, ymin, xmax, ymax = bounds
+    col = np.floor((x - xmin) / ((xmax - xmin) / cols)).astype(np.int64)
+    row = np.floor((y - ymin) / ((ymax - ymin) / rows)).astype(np.int64)
+    inside = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+    col = np.minimum(col, cols - 1)
+    row = np.minimum(row, rows - 1)
+    return np.where(inside, row * cols + col, -1)
+
+
+def quadtree_split(counts, rootCols, rootRows, maxFeatures):
+    """
+    Recursively splits each root cell into 4 until it holds at most maxFeatures features.
+    Works only from feature counts of a fine base grid, whose cells are the smallest possible fragments.
+    Cells without features are not returned.
+
+    :Parameters:
+      - `counts: number of features in each cell of base grid, array (rows, cols), row 0 at the bottom.
+                 Base grid has rootCols * 2**depth columns and rootRows * 2**depth rows.
+      - `rootCols, rootRows: size of the initial grid
+      - `maxFeatures: maximum number of features in one cell
+
+    :Returns:
+      - leaves: list of (row, col, size, features) in base grid cells, ordered by root cell
+                (columns from the left, rows from the top) and then depth first (top left child first)
+
+    :Returns Type:
+      list
+    """
+    size = counts.shape[1] // rootCols
+    # Summed area table: number of features in any block of base cells in constant time
+    table = np.zeros((counts.shape[0] + 1, counts.shape[1] + 1), dtype=np.int64)
+    table[1:, 1:] = counts.cumsum(axis=0).cumsum(axis=1)
+
+    def features(row, col, size):
+        return int(table[row + size, col + size] - table[row, col + size] - table[row + size, col] + table[row, col])
+
+    leaves = []
+    for rootCol in range(rootCols):
+        for rootRow in reversed(range(rootRows)):
+            stack = [(rootRow * size, rootCol * size, size)]
+            while stack:
+                row, col, cellSize = stack.pop()
+                n = features(row, col, cellSize)
+                if n == 0:
+                    continue
+                if n <= maxFeatures or cellSize == 1:
+                    leaves.append((row, col, cellSize, n))
+                    continue
+                half = cellSize // 2
+                # Pushed in reverse so that top left child is processed first
+                for childRow, childCol in [(row, col + half), (row, col), (row + half, col + half), (row + half, col)]:
+                    stack.append((childRow, childCol, half))
+    return leaves
+
+
+def quadtree_grid(x, y, bounds, maxFeatures, cols, rows, maxDepth = 6):
+    """
+    Adaptive grid: cells of regular cols x rows grid are split by quadtree until they hold at most
+    maxFeatures points (or reach maxDepth). Points are counted on a base grid of the finest level and
+    assigned to the cells by arithmetic, so no density layer or spatial predicates are needed.
+    Cells without points are not created.
+
+    :Parameters:
+      - `x, y: coordinates of points (e.g. building centroids)
+      - `bounds: (xmin, ymin, xmax, ymax) of the grid
+      - `maxFeatures: maximum number of points in one cell
+      - `cols, rows: size of the initial grid
+      - `maxDepth: maximum number of splits of the initial cells
+
+    :Returns:
+      - grid: GeoDataFrame of cells with number of points in column 'features'
+      - cell: position of cell in grid for every point, -1 for points outside bounds
+
+    :Returns Type:
+      tuple
+    """
+    xmin, ymin, xmax, ymax = bounds
+    baseCols, baseRows = cols * 2**maxDepth, rows * 2**maxDepth
+    position = grid_position(x, y, bounds, baseCols, baseRows)
+    counts = np.bincount(position[position >= 0], minlength=baseCols * baseRows).reshape(baseRows, baseCols)
+    leaves = quadtree_split(counts, cols, rows, maxFeatures)
+
+    # Lookup table base cell -> leaf
+    leafOf = np.full((baseRows, baseCols), -1, dtype=np.int64)
+    for i, (row, col, size, n) in enumerate(leaves):
+        leafOf[row:row + size, col:col + size] = i
+    cell = np.where(position >= 0, leafOf.ravel()[position], -1)
+
+    leaves = np.array(leaves, dtype=np.int64).reshape(-1, 4)
+    width, height = (xmax - xmin) / baseCols, (ymax - ymin) / baseRows
+    geometry = shapely.box(xmin + leaves[:, 1] * width, ymin + leaves[:, 0] * height,
+                           xmin + (leaves[:, 1] + leaves[:, 2]) * width, ymin + (leaves[:, 0] + leaves[:, 2]) * height)
+    grid = gpd.GeoDataFrame({'features': leaves[:, 3]}, geometry=geometry, crs="EPSG:4326")
+    return grid, cell
+
+
+def report_fragment_sizes(sizes, maxFeatures = None):
+    """
+    Prints distribution of number of features per fragment.
+    """
+    sizes = np.asarray(sizes)
+    print("Fragments: " + str(len(sizes)) + ", features: " + str(int(sizes.sum())))
+    print("  min " + str(int(sizes.min())) + ", p10 " + str(int(np.percentile(sizes, 10))) + ", median " + str(int(np.median(sizes)))
+          + ", p90 " + str(int(np.percentile(sizes, 90))) + ", max " + str(int(sizes.max())))
+    if maxFeatures is not None:
+        print("  over limit of " + str(maxFeatures) + ": " + str(int((sizes > maxFeatures).sum())))
+
+
+def write_geojson(gdf, path):
+    """
+    Writes GeoJSON atomically: into a temporary file in the same directory, which is then renamed to path.
+    Readers never see partially written file. Layer name is set explicitly, so output does not depend
+    on the temporary file name and the same data always give the same bytes.
+
+    :Returns:
+      - path, size of the file in bytes
+
+    :Returns Type:
+      tuple
+    """
+    # Unique temporary file, so writers of the same path or files left by a crashed run do not clash
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.geojson')
+    os.close(descriptor)
+    try:
+        gdf.to_file(temporary, driver='GeoJSON', layer=os.path.splitext(os.path.basename(path))[0])
+        os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    return path, os.path.getsize(path)
+
+
+def write_fragments(fragments, workers = None):
+    """
+    Writes fragments to GeoJSON on a process pool. At most 2 fragments per worker are waiting
+    for a free worker, so fragments are not all copied into the pool at once.
+
+    :Parameters:
+      - `fragments: iterable of (path, GeoDataFrame)
+      - `workers: number of processes. Default: all CPU cores
+
+    :Returns:
+      - paths: written paths in order of fragments
+
+    :Returns Type:
+      list
+    """
+    workers = workers or os.cpu_count()
+    start = time.perf_counter()
+    paths = []
+    size = 0
+    pending = set()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for path, gdf in fragments:
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                size += sum(future.result()[1] for future in done)
+            pending.add(pool.submit(write_geojson, gdf, path))
+            paths.append(path)
+        size += sum(future.result()[1] for future in pending)
+    print("Wrote " + str(len(paths)) + " fragments on " + str(workers) + " workers in " + str(round(time.perf_counter() - start, 2)) + " s, "
+          + str(round(size / 2**20, 1)) + " MB")
+    return paths
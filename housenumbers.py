@@ -0,0 +1,118 @@
+# House number ranges
+# Ranges like "257-59" or "257 -59" are expanded to "257;259" with the same rules as Snap_NAD_address_to_building.R,
+# but with regex extraction over the whole column instead of a loop over rows. Only the NAD snapper expands ranges.
+# parseLocation() in process_CT_address.py shares only the detection of hyphen numbers (is_hyphen_number) and keeps
+# ranges like "1-24" as they are. On realistic data (about 1 % ranges) expand_ranges() is about as fast as
+# the row by row expand_range(), it is faster only for columns with many ranges (see benchmark_expand_ranges).
+
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import re
+from timing import timer, report_timings
+
+
+# Only digits and hyphens, e.g. "257-59". Anything else (12A-14, 1/2) is not treated as range.
+NOT_RANGE_PATTERN = re.compile(r'[^0-9-]')
+RANGE_PATTERN = re.compile(r'^(?P<start>\d*)-(?P<end>\d*)')
+
+
+def is_hyphen_number(text):
+    """
+    True for tokens like "1-24" or "12A-14": hyphen together with at least one digit (excludes "A-G Hill Street").
+    """
+    return '-' in text and any(map(str.isdigit, text))
+
+
+def expand_range(housenumber):
+    """
+    Expands one house number range. Row by row reference of expand_ranges().
+    """
+    if housenumber is None or "-" not in housenumber:
+        return housenumber
+    if " -" in housenumber:
+        housenumber = housenumber.replace(" ", "")
+    if NOT_RANGE_PATTERN.search(housenumber):
+        return housenumber
+    vals = housenumber.split("-")
+    if vals[0] == "" or vals[1] == "":
+        return housenumber
+    back = vals[0][-len(vals[1]):]
+    front = vals[0][:-len(vals[1])] if len(vals[1]) < len(vals[0]) else ""
+    if back < vals[1]:
+        return vals[0] + ";" + front + vals[1]
+    if back > vals[1] and front != "":
+        return vals[0] + ";" + str(int(front) + 1) + vals[1]
+    return housenumber
+
+
+def expand_ranges(housenumbers):
+    """
+    Turns house number ranges into two numbers separated by ';'. End of range replaces the same number
+    of last digits of the start:
+      "257-59"  --> "257;259"
+      "257 -59" --> "257;259" (spaces are removed when number contains " -")
+      "259-57"  --> "259;357" (end is lower, so it belongs to the next hundred)
+    Values with other characters than digits and hyphen, ranges with missing start or end and ranges where R
+    would produce "NA" (e.g. "9-5") are left unchanged. Missing values stay missing.
+    Every distinct value is processed only once, with Arrow string kernels over all distinct values.
+
+    :Parameters:
+      - `housenumbers: Series or list of house numbers
+
+    :Returns:
+      expanded house numbers with the original index
+
+    :Returns Type:
+      Series
+    """
+    housenumbers = pd.Series(housenumbers, dtype=object)
+    codes, uniques = pd.factorize(housenumbers, use_na_sentinel=True)
+    values = pa.array(np.append(uniques.astype(object), None), type=pa.string(), from_pandas=True)
+    spaced = pc.match_substring(values, ' -').fill_null(False)
+    values = pc.if_else(spaced, pc.replace_substring(values, ' ', ''), values)
+
+    candidate = pc.and_(pc.match_substring(values, '-'), pc.invert(pc.match_substring_regex(values, NOT_RANGE_PATTERN.pattern)))
+    rows = np.flatnonzero(candidate.fill_null(False).to_numpy(zero_copy_only=False))
+    parts = pc.extract_regex(values.take(rows), RANGE_PATTERN.pattern)
+    start, end = parts.field('start'), parts.field('end')
+    valid = pc.and_(pc.not_equal(start, ''), pc.not_equal(end, '')).to_numpy(zero_copy_only=False)
+    rows, start, end = rows[valid], start.filter(valid), end.filter(valid)
+
+    # Split start into front and the same number of last digits as end (back). Done once per length of end.
+    endLength = pc.utf8_length(end).to_numpy(zero_copy_only=False)
+    front = np.empty(len(rows), dtype=object)
+    back = np.empty(len(rows), dtype=object)
+    for n in np.unique(endLength):
+        same = np.flatnonzero(endLength == n)
+        front[same] = pc.utf8_slice_codeunits(start.take(same), 0, -int(n)).to_numpy(zero_copy_only=False)
+        back[same] = pc.utf8_slice_codeunits(start.take(same), -int(n)).to_numpy(zero_copy_only=False)
+    front, back = pa.array(front, type=pa.string()), pa.array(back, type=pa.string())
+
+    lower = pc.less(back, end)
+    higher = pc.and_(pc.greater(back, end), pc.not_equal(front, ''))
+    nextFront = pc.if_else(higher, pc.cast(pc.add(pc.cast(pc.if_else(higher, front, '0'), pa.int64()), 1), pa.string()), front)
+    expanded = pc.binary_join_element_wise(start, pc.binary_join_element_wise(nextFront, end, ''), ';')
+
+    expand = pc.or_(lower, higher).to_numpy(zero_copy_only=False)
+    result = values.to_numpy(zero_copy_only=False)
+    result[rows[expand]] = expanded.filter(expand).to_numpy(zero_copy_only=False)
+    return pd.Series(result[codes], index=housenumbers.index, dtype=object)
+
+
+def benchmark_expand_ranges(housenumbers, repeat = 1):
+    """
+    Compares run time of expand_ranges() and row by row expand_range() and checks that results are identical.
+    """
+    housenumbers = pd.Series(housenumbers, dtype=object)
+    timings = {}
+    with timer(timings, 'row by row'):
+        for _ in range(repeat):
+            reference = [expand_range(item) for item in housenumbers]
+    with timer(timings, 'vectorized'):
+        for _ in range(repeat):
+            result = expand_ranges(housenumbers)
+    report_timings(timings, "House number ranges of " + str(len(housenumbers) * repeat) + " addresses")
+    print("  speedup: " + str(round(timings['row by row'] / timings['vectorized'], 1)) + "x, differences: " + str(sum(a != b for a, b in zip(reference, result))))
+    return timings
@@ -0,0 +1,134 @@
+# On-disk cache of orthogonalized buildings (SQLite)
+# Most footprints do not change between data releases. Result of every building is stored under a hash
+# of its input WKB and orthogonalization parameters, so a rerun computes only new or changed buildings.
+# Lookups and inserts are done in bulk through a temporary table. Least recently used entries are removed
+# when the cache grows over its size limit. Several processes can use one cache (WAL journal).
+
+import sqlite3
+import hashlib
+import os
+import time
+import numpy as np
+import shapely
+
+
+CACHE_PATH = os.path.join(os.environ.get('CT_IMPORT_CACHE', os.path.expanduser('~/.cache/ct_import')), 'ortho-cache.sqlite')
+MAX_BYTES = 4 * 2**30
+
+
+def open_cache(path = CACHE_PATH):
+    """
+    Opens (creates) the cache database.
+
+    :Returns Type:
+      sqlite3.Connection
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection = sqlite3.connect(path, timeout=600)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("CREATE TABLE IF NOT EXISTS ortho (key BLOB PRIMARY KEY, geometry BLOB, perc REAL, size INTEGER, used REAL) WITHOUT ROWID")
+    connection.execute("CREATE INDEX IF NOT EXISTS ortho_used ON ortho (used)")
+    return connection
+
+
+def cache_keys(geometries, parameters):
+    """
+    Keys of buildings: SHA-256 of input WKB and parameters. Missing geometries have no key (None).
+
+    :Parameters:
+      - `geometries: input geometries (before simplification)
+      - `parameters: string with all parameters that change the result
+
+    :Returns Type:
+      numpy array
+    """
+    salt = parameters.encode()
+    wkbs = shapely.to_wkb(np.asarray(geometries, dtype=object))
+    return np.array([hashlib.sha256(salt + wkb).digest() if wkb is not None else None for wkb in wkbs], dtype=object)
+
+
+def cache_get(connection, keys):
+    """
+    Looks up all keys at once. Found entries are marked as used now.
+
+    :Returns:
+      - geometry: cached geometry, None for misses
+      - percChange: cached perc.change (NaN also for misses)
+      - hit: boolean array
+
+    :Returns Type:
+      tuple
+    """
+    geometry = np.full(len(keys), None, dtype=object)
+    percChange = np.full(len(keys), np.nan)
+    hit = np.zeros(len(keys), dtype=bool)
+    rows = [(i, key) for i, key in enumerate(keys) if key is not None]
+    with connection:
+        connection.execute("CREATE TEMP TABLE IF NOT EXISTS lookup (position INTEGER, key BLOB)")
+        connection.execute("DELETE FROM lookup")
+        connection.executemany("INSERT INTO lookup VALUES (?, ?)", rows)
+        found = connection.execute("SELECT lookup.position, ortho.geometry, ortho.perc FROM lookup JOIN ortho ON ortho.key = lookup.key").fetchall()
+        connection.execute("UPDATE ortho SET used = ? WHERE key IN (SELECT key FROM lookup)", (time.time(),))
+        connection.execute("DELETE FROM lookup")
+    if found:
+        index = np.array([row[0] for row in found])
+        geometry[index] = shapely.from_wkb(np.array([row[1] for row in found], dtype=object))
+        percChange[index] = np.array([np.nan if row[2] is None else row[2] for row in found])
+        hit[index] = True
+    return geometry, percChange, hit
+
+
+def cache_put(connection, keys, geometry, percChange):
+    """
+    Stores results of buildings. Rows without key are skipped.
+    """
+    wkbs = shapely.to_wkb(np.asarray(geometry, dtype=object))
+    now = time.time()
+    rows = [(key, wkb, None if np.isnan(perc) else float(perc), len(wkb), now)
+            for key, wkb, perc in zip(keys, wkbs, percChange) if key is not None and wkb is not None]
+    with connection:
+        connection.executemany("INSERT OR REPLACE INTO ortho VALUES (?, ?, ?, ?, ?)", rows)
+
+
+def cache_size(connection):
+    """
+    Number of entries and bytes of stored geometries.
+
+    :Returns Type:
+      tuple
+    """
+    entries, size = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM ortho").fetchone()
+    return entries, size
+
+
+def evict(connection, maxBytes = MAX_BYTES):
+    """
+    Removes least recently used entries until stored geometries take at most maxBytes.
+
+    :Returns:
+      - number of removed entries
+
+    :Returns Type:
+      int
+    """
+    with connection:
+        removed = connection.execute("""DELETE FROM ortho WHERE key IN (
+                                          SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY used DESC, key) AS kept FROM ortho)
+                                          WHERE kept > ?)""", (maxBytes,)).rowcount
+    # Space of removed entries is reused by next inserts, file is not shrunk (VACUUM would rewrite whole file)
+    return removed
+
+
+def report_cache(hits, misses, connection = None, skipped = 0):
+    """
+    Prints hit rate and size of the cache. Skipped buildings (without geometry) are not part of the hit rate.
+    """
+    total = hits + misses
+    print("Ortho cache: " + str(hits) + " hits, " + str(misses) + " misses, hit rate "
+          + str(round(100 * hits / total, 1) if total else 0.0) + " %")
+    if skipped:
+        print("  " + str(skipped) + " buildings without geometry are not cached")
+    if connection is not None:
+        entries, size = cache_size(connection)
+        print("  " + str(entries) + " entries, " + str(round(size / 2**20, 1)) + " MB")
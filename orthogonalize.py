@@ -9,9 +9,45 @@ from shapely.geometry import MultiPolygon
 from shapely import affinity
 import math
 import statistics
+import numpy as np
+import pyproj
+import functools
+from timing import timer, report_timings
+from storage import save_stage
+from ortho_cache import cache_keys, cache_get, cache_put
 speedups.enable()
 
 
+EARTH_RADIUS = 6378137.0    # Radius of EPSG:3857 sphere in meters
+
+# Simplification tolerances (degrees) before and after orthogonalization
+SIMPLIFY_TOLERANCE = 0.000005
+FINAL_SIMPLIFY_TOLERANCE = 0.000001
+# Orthogonalized part is rejected when it keeps less than MIN_RETENTION of the area and the original
+# segments deviate from cardinal directions by more than MAX_STDEV degrees (see select_orthogonalized)
+MIN_RETENTION = 0.95
+MAX_STDEV = 9
+# Parameters of cached results (see ortho_cache.py). Increase ORTHO_VERSION when orthogonalization changes its results.
+ORTHO_VERSION = 1
+ORTHO_PARAMETERS = ';'.join(str(p) for p in [ORTHO_VERSION, SIMPLIFY_TOLERANCE, FINAL_SIMPLIFY_TOLERANCE, 'mercator', MIN_RETENTION, MAX_STDEV])
+
+
+@functools.lru_cache(maxsize=None)
+def get_transformer(crsFrom, crsTo):
+    """
+    Returns cached pyproj Transformer between two coordinate systems (always in lon/lat order).
+    """
+    return pyproj.Transformer.from_crs(crsFrom, crsTo, always_xy=True)
+
+
+def transform_geometry(geom, crsFrom, crsTo):
+    """
+    Reprojects coordinates of a shapely geometry without creating GeoDataFrame.
+    """
+    transformer = get_transformer(crsFrom, crsTo)
+    return shapely.transform(geom, lambda coords: np.column_stack(transformer.transform(coords[:, 0], coords[:, 1])))
+
+
 def calculate_initial_compass_bearing(pointA, pointB):
     """
     Calculates the bearing between two points.
@@ -124,15 +160,10 @@ def rotate_polygon(polySimple, angle):
     :Returns Type:
       shapely polygon
     """
-    # Create WGS84 referenced GeoSeries
-    bS = gpd.GeoDataFrame({'geometry':[polySimple]})
-    bS.crs = "EPSG:4326"
     # Temporary reproject to Merkator and rotate by median angle
-    bSR = bS.to_crs('epsg:3857')
-    bSR = bSR.rotate(angle, origin='centroid', use_radians=False) 
-    bSR = bSR.to_crs('epsg:4326')
-    # Extract only shapely polygon object
-    bSR = bSR[0]
+    bSR = transform_geometry(polySimple, "EPSG:4326", "EPSG:3857")
+    bSR = affinity.rotate(bSR, angle, origin='centroid', use_radians=False) 
+    bSR = transform_geometry(bSR, "EPSG:3857", "EPSG:4326")
     return bSR
 
 
@@ -237,59 +268,681 @@ def orthogonalize_polygon(polygon):
     return polyOrthog
 
 
-#### Main Part
+#### Batch mode
+# Array implementation of orthogonalize_polygon() that processes all rings of a slice at once.
+# Rings are passed as flat coordinate arrays with ring offsets (as returned by shapely.to_ragged_array),
+# where ring r occupies points ringOffsets[r] ... ringOffsets[r+1]-1 and its first and last points are the same.
 
-import fiona
-import sys
-import numpy
 
+def ring_segment_index(ringOffsets):
+    """
+    Builds index arrays describing segments of rings stored in flat coordinate arrays.
 
-shpfile = fiona.open('/Buildigns_footprints_testing/geo_export_98ca6254-03aa-48e1-8931-a446a182959c.shp')
-args = sys.argv
-sliceNo = int(args[1])
-buildings = gpd.GeoDataFrame.from_features(shpfile[ sliceNo*50000 : (sliceNo+1)*50000 ])
+    :Parameters:
+      - `ringOffsets: array of nRings + 1 offsets into the flat coordinate arrays.
+
+    :Returns:
+      - nSeg: number of segments in each ring
+      - segOffsets: nRings + 1 offsets into the flat segment arrays
+      - segRing: ring number of each segment
+      - segLocal: position of each segment within its ring
+      - segStart: index of the first point of each segment in the flat coordinate arrays
+
+    :Returns Type:
+      numpy arrays
+    """
+    ringOffsets = np.asarray(ringOffsets, dtype=np.int64)
+    nSeg = np.diff(ringOffsets) - 1
+    segOffsets = np.concatenate(([0], np.cumsum(nSeg)))
+    segRing = np.repeat(np.arange(len(nSeg)), nSeg)
+    segLocal = np.arange(segOffsets[-1]) - segOffsets[segRing]
+    segStart = ringOffsets[segRing] + segLocal
+    return nSeg, segOffsets, segRing, segLocal, segStart
 
-buildings.crs = "EPSG:4326"
-buildings.to_file('/Buildigns_footprints_testing/raw/BuildCT_raw_' + str(sliceNo) + '.geojson', driver='GeoJSON')
 
-buildings['geometry'] = buildings['geometry'].simplify(0.000005, preserve_topology=True)
+def calculate_compass_bearings(x, y, segStart):
+    """
+    Array version of calculate_initial_compass_bearing() for all segments at once.
+
+    :Parameters:
+      - `x, y: flat arrays of longitudes and latitudes in decimal degrees.
+      - `segStart: index of the first point of each segment.
 
-for i in range(0, len(buildings)):
-    build = buildings.loc[i, 'geometry']
-    if build.type == 'MultiPolygon':
-        multipolygon = []
-        # For multipolygons process all polygon rings one-by-one
-        for poly in build:
-            buildOrtho = orthogonalize_polygon(poly)
-            x = gpd.overlay(gpd.GeoDataFrame({'geometry':[buildOrtho]}, crs="EPSG:4326").loc[0:0], gpd.GeoDataFrame({'geometry':[poly]}, crs="EPSG:4326").loc[0:0], how='intersection')
+    :Returns:
+      Bearings of all segments in degrees
+
+    :Returns Type:
+      numpy array
+    """
+    lat1 = np.radians(y[segStart])
+    lat2 = np.radians(y[segStart + 1])
+    diffLong = np.radians(x[segStart + 1] - x[segStart])
+    a = np.sin(diffLong) * np.cos(lat2)
+    b = np.cos(lat1) * np.sin(lat2) - (np.sin(lat1) * np.cos(lat2) * np.cos(diffLong))
+    return (np.degrees(np.arctan2(a, b)) + 360) % 360
+
+
+def calculate_planar_bearings(x, y, segStart):
+    """
+    Calculates bearings of all segments in projected (conformal) coordinates.
+
+    :Returns:
+      Bearings of all segments in degrees
+
+    :Returns Type:
+      numpy array
+    """
+    dx = x[segStart + 1] - x[segStart]
+    dy = y[segStart + 1] - y[segStart]
+    return (np.degrees(np.arctan2(dx, dy)) + 360) % 360
+
+
+def project_rings(x, y, ringOffsets, projection):
+    """
+    Projects lon/lat coordinates of rings to planar coordinates in meters.
+
+    :Parameters:
+      - `x, y: flat arrays of longitudes and latitudes in decimal degrees.
+      - `projection: 'mercator' = EPSG:3857 using cached pyproj Transformer
+                     'local' = equirectangular approximation around the first point of each ring
+
+    :Returns:
+      - px, py: projected coordinates
+      - unproject: function converting projected coordinates back to lon/lat
+
+    :Returns Type:
+      numpy arrays, function
+    """
+    if projection == 'mercator':
+        px, py = get_transformer("EPSG:4326", "EPSG:3857").transform(x, y)
+        return px, py, lambda px, py: get_transformer("EPSG:3857", "EPSG:4326").transform(px, py)
+    elif projection == 'local':
+        nPts = np.diff(ringOffsets)
+        lon0 = np.repeat(x[ringOffsets[:-1]], nPts)
+        lat0 = np.repeat(y[ringOffsets[:-1]], nPts)
+        ky = EARTH_RADIUS * math.pi / 180
+        kx = ky * np.cos(np.radians(lat0))
+        return (x - lon0) * kx, (y - lat0) * ky, lambda px, py: (px / kx + lon0, py / ky + lat0)
+    raise ValueError("Unknown projection: " + str(projection))
+
+
+def classify_bearings(angle, limit):
+    """
+    Assigns cardinal directions to bearings in the same order of tests as calculate_segment_angles().
+
+    :Parameters:
+      - `angle: array of segment bearings.
+      - `limit: array of shape (len(angle), 4) with angle limits for directions [N, E, S, W].
+
+    :Returns:
+      - corAngle: Segments angles to closest cardinal direction
+      - dirAngle: Segments direction [N, E, S, W] as [0, 1, 2, 3]
+
+    :Returns Type:
+      numpy arrays
+    """
+    conditions = [
+        (angle > (45 + limit[:, 1])) & (angle <= (135 - limit[:, 1])),
+        (angle > (135 + limit[:, 2])) & (angle <= (225 - limit[:, 2])),
+        (angle > (225 + limit[:, 3])) & (angle <= (315 - limit[:, 3])),
+        (angle > (315 + limit[:, 0])) & (angle <= 360),
+        (angle >= 0) & (angle <= (45 - limit[:, 0])),
+    ]
+    corAngle = np.select(conditions, [angle - 90, angle - 180, angle - 270, angle - 360, angle], default=np.nan)
+    dirAngle = np.select(conditions, [1, 2, 3, 0, 0], default=-1)
+    return corAngle, dirAngle
+
+
+def calculate_segment_angles_batch(angle, nSeg, segOffsets, maxAngleChange = 45):
+    """
+    Array version of calculate_segment_angles() for segments of many rings.
+
+    Direction of a segment depends on the direction of the previous segment in the same ring,
+    therefore for maxAngleChange < 45 segments are processed position by position, 
+    but at each position for all rings at once.
+
+    :Parameters:
+      - `angle: bearings of all segments (see calculate_compass_bearings).
+      - `nSeg, segOffsets: segment counts and offsets of rings (see ring_segment_index).
+      - `maxAngleChange: angle (0,45> degrees. See calculate_segment_angles().
+
+    :Returns:
+      - corAngle: Segments angles to closest cardinal direction
+      - dirAngle: Segments direction [N, E, S, W] as [0, 1, 2, 3]
+
+    :Returns Type:
+      numpy arrays
+    """
+    maxAngleChange = 45 - maxAngleChange
+    limit = np.zeros((len(angle), 4))
+    if maxAngleChange == 0 or len(angle) == 0:
+        return classify_bearings(angle, limit)
+    corAngle = np.empty(len(angle))
+    dirAngle = np.empty(len(angle), dtype=np.int64)
+    # Rings sorted from the longest so that rings still active at position j are always the first ones
+    order = np.argsort(-nSeg, kind='stable')
+    nActive = np.searchsorted(-nSeg[order], -np.arange(nSeg.max()), side='left')
+    cardinal = np.arange(4)
+    for j in range(nSeg.max()):
+        idx = segOffsets[order[:nActive[j]]] + j
+        if j == 0:
+            segLimit = limit[idx]
+        else:
+            # Same limits as calculate_segment_angles() sets after the previous segment
+            turn = (cardinal[None, :] - dirAngle[idx - 1][:, None]) % 4
+            segLimit = np.where(turn == 0, maxAngleChange, np.where(turn == 2, 0, -maxAngleChange))
+        corAngle[idx], dirAngle[idx] = classify_bearings(angle[idx], segLimit)
+    return corAngle, dirAngle
+
+
+def ring_centroids(x, y, segOffsets, segStart):
+    """
+    Calculates area centroids of rings stored in flat coordinate arrays.
+    Coordinates are taken relative to the first point of each ring to preserve precision.
+    Rings with zero area fall back to the centroid of their segments (as in GEOS) or of their vertices.
+
+    :Returns:
+      - cx, cy: centroid coordinates of each ring
+
+    :Returns Type:
+      numpy arrays
+    """
+    segRingStart = np.repeat(segStart[segOffsets[:-1]], np.diff(segOffsets))
+    x0 = x[segRingStart]
+    y0 = y[segRingStart]
+    xs = x[segStart] - x0
+    ys = y[segStart] - y0
+    xe = x[segStart + 1] - x0
+    ye = y[segStart + 1] - y0
+    cross = xs * ye - xe * ys
+    area = np.add.reduceat(cross, segOffsets[:-1]) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cx = np.add.reduceat((xs + xe) * cross, segOffsets[:-1]) / (6 * area)
+        cy = np.add.reduceat((ys + ye) * cross, segOffsets[:-1]) / (6 * area)
+    flat = (area == 0) | ~np.isfinite(cx) | ~np.isfinite(cy)
+    if flat.any():
+        nSeg = np.diff(segOffsets)
+        length = np.hypot(xe - xs, ye - ys)
+        totalLength = np.add.reduceat(length, segOffsets[:-1])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lx = np.add.reduceat((xs + xe) * length, segOffsets[:-1]) / (2 * totalLength)
+            ly = np.add.reduceat((ys + ye) * length, segOffsets[:-1]) / (2 * totalLength)
+        point = totalLength == 0
+        lx[point] = (np.add.reduceat(xs, segOffsets[:-1]) / nSeg)[point]
+        ly[point] = (np.add.reduceat(ys, segOffsets[:-1]) / nSeg)[point]
+        cx[flat] = lx[flat]
+        cy[flat] = ly[flat]
+    return cx + x0[segOffsets[:-1]], cy + y0[segOffsets[:-1]]
+
+
+def rotate_rings_planar(x, y, ringOffsets, segOffsets, segStart, angle):
+    """
+    Rotates every ring around its centroid as an affine transformation of planar coordinates.
+
+    :Parameters:
+      - `x, y: flat arrays of projected coordinates.
+      - `angle: angle of rotation of each ring in decimal degrees.  
+                Positive = counter-clockwise, Negative = clockwise 
+
+    :Returns:
+      - x, y: rotated coordinates
+
+    :Returns Type:
+      numpy arrays
+    """
+    cx, cy = ring_centroids(x, y, segOffsets, segStart)
+    # Same affine matrix as shapely.affinity.rotate
+    angle = np.radians(angle)
+    cosp = np.cos(angle)
+    sinp = np.sin(angle)
+    cosp[np.abs(cosp) < 2.5e-16] = 0.0
+    sinp[np.abs(sinp) < 2.5e-16] = 0.0
+    xoff = cx - cx * cosp + cy * sinp
+    yoff = cy - cx * sinp - cy * cosp
+    nPts = np.diff(ringOffsets)
+    cosp, sinp, xoff, yoff = [np.repeat(v, nPts) for v in (cosp, sinp, xoff, yoff)]
+    return cosp * x - sinp * y + xoff, sinp * x + cosp * y + yoff
+
+
+def rotate_rings(x, y, ringOffsets, segOffsets, segStart, angle):
+    """
+    Array version of rotate_polygon(). Rotates every ring around its centroid in EPSG:3857.
+
+    :Parameters:
+      - `x, y: flat arrays of longitudes and latitudes in decimal degrees.
+      - `angle: angle of rotation of each ring in decimal degrees.  
+
+    :Returns:
+      - x, y: rotated coordinates in decimal degrees
+
+    :Returns Type:
+      numpy arrays
+    """
+    mx, my = get_transformer("EPSG:4326", "EPSG:3857").transform(x, y)
+    rx, ry = rotate_rings_planar(mx, my, ringOffsets, segOffsets, segStart, angle)
+    return get_transformer("EPSG:3857", "EPSG:4326").transform(rx, ry)
+
+
+def average_segment_runs(x, y, ringOffsets, runStart, runEnd, runRing, runAxis):
+    """
+    Replaces coordinates of points in each straight run of segments by their mean.
+    Runs of segments are processed in the same order as in orthogonalize_polygon(), 
+    i.e. k-th run of all rings at once, because consecutive runs share a point.
+
+    :Parameters:
+      - `x, y: flat coordinate arrays. Modified in place.
+      - `runStart, runEnd: local index of the first and last segment of each run (ordered by ring and position).
+      - `runRing: ring number of each run.
+      - `runAxis: 0 = average x coordinates (N,S segments), 1 = average y coordinates (E,W segments)
+    """
+    if len(runRing) == 0:
+        return
+    runOffsets = np.flatnonzero(np.r_[True, runRing[1:] != runRing[:-1]])
+    runRank = np.arange(len(runRing)) - np.repeat(runOffsets, np.diff(np.r_[runOffsets, len(runRing)]))
+    for k in range(runRank.max() + 1):
+        sel = np.flatnonzero(runRank == k)
+        first = ringOffsets[runRing[sel]] + runStart[sel]
+        nPts = runEnd[sel] - runStart[sel] + 2  # Segment has 2 points therefore +2
+        groupStart = np.concatenate(([0], np.cumsum(nPts)[:-1]))
+        pts = np.repeat(first - groupStart, nPts) + np.arange(nPts.sum())
+        for axis, coords in ((0, x), (1, y)):
+            onAxis = np.repeat(runAxis[sel] == axis, nPts)
+            if not onAxis.any():
+                continue
+            mean = np.add.reduceat(coords[pts], groupStart) / nPts
+            coords[pts[onAxis]] = np.repeat(mean, nPts)[onAxis]
+        # Copy change in first point to its last point so we don't lose it during Reverse shift
+        closing = sel[runStart[sel] == 0]
+        last = ringOffsets[runRing[closing] + 1] - 1
+        x[last] = x[ringOffsets[runRing[closing]]]
+        y[last] = y[ringOffsets[runRing[closing]]]
+
+
+def orthogonalize_rings(x, y, ringOffsets, projection = 'mercator', timings = None):
+    """
+    Batch version of orthogonalize_polygon() that orthogonalizes many rings at once. 
+
+    With projection=None each ring is processed the same way as a ring in orthogonalize_polygon() 
+    and gives the same coordinates up to floating point precision. That is, bearings are 
+    calculated from lat/lon and coordinates are reprojected to EPSG:3857 for every rotation.
+    Otherwise coordinates are projected once, all steps run on planar coordinates and the
+    result is projected back once at the end. Differences to orthogonalize_polygon() are then 
+    well below the precision of the input data.
+
+    :Parameters:
+      - `x, y: flat arrays of longitudes and latitudes of closed rings in decimal degrees.
+      - `ringOffsets: array of nRings + 1 offsets into x, y.
+      - `projection: None, 'mercator' or 'local' (see project_rings).
+      - `timings: optional dictionary that collects time spent in individual steps.
+
+    :Returns:
+      - x, y: orthogonalized coordinates
+      - corStdev: standard deviation of segment angles to closest cardinal direction 
+                  of each original ring (as used by orthogonalize_polygon())
+
+    :Returns Type:
+      numpy arrays
+    """
+    x = np.array(x, dtype=float)
+    y = np.array(y, dtype=float)
+    ringOffsets = np.asarray(ringOffsets, dtype=np.int64)
+    nSeg, segOffsets, segRing, segLocal, segStart = ring_segment_index(ringOffsets)
+    if projection is None:
+        bearings = calculate_compass_bearings
+        rotate = rotate_rings
+    else:
+        with timer(timings, 'project'):
+            x, y, unproject = project_rings(x, y, ringOffsets, projection)
+        bearings = calculate_planar_bearings
+        rotate = rotate_rings_planar
+    with timer(timings, 'angles'):
+        # Get angles from cardinal directions of all segments
+        corAngle, dirAngle = calculate_segment_angles_batch(bearings(x, y, segStart), nSeg, segOffsets)
+        # Calculate median angle that will be used for rotation
+        ringStarts = segOffsets[:-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corMean = np.add.reduceat(corAngle, ringStarts) / nSeg
+            corStdev = np.sqrt(np.add.reduceat((corAngle - corMean[segRing]) ** 2, ringStarts) / (nSeg - 1))
+        corSorted = corAngle[np.lexsort((corAngle, segRing))]
+        medAngle = (corSorted[ringStarts + (nSeg - 1) // 2] + corSorted[ringStarts + nSeg // 2]) / 2
+        # Account for cases when building is at ~45˚ and we can't decide if to turn clockwise or anti-clockwise
+        medAngle = np.where(corStdev < 30, medAngle, 45)
+    with timer(timings, 'rotate'):
+        # Rotate polygon to align its edges to cardinal directions
+        rotatedX, rotatedY = rotate(x, y, ringOffsets, segOffsets, segStart, medAngle)
+    with timer(timings, 'angles'):
+        # Get directions of rotated polygon segments
+        orgAngle = bearings(rotatedX, rotatedY, segStart)
+        corAngle, dirAngle = calculate_segment_angles_batch(orgAngle, nSeg, segOffsets, 15)
+    with timer(timings, 'average'):
+        # Account for 180 degree turns
+        segNext = segOffsets[segRing] + (segLocal + 1) % nSeg[segRing]
+        segPrev = segOffsets[segRing] + (segLocal - 1) % nSeg[segRing]
+        dirAngle = np.where(np.abs(dirAngle - dirAngle[segNext]) == 2, dirAngle[segPrev], dirAngle)
+        # Scan backwards to check if starting segment is a continuation of straight region in the same direction
+        breaks = (dirAngle != dirAngle[segOffsets[segRing]]) & (segLocal > 0)
+        shift = nSeg - 1 - np.maximum.reduceat(np.where(breaks, segLocal, 0), ringStarts)
+        # If the first segment is part of continuing straight region then reset the index to it's beginning
+        segShift = shift[segRing]
+        segSource = segOffsets[segRing] + (segLocal - segShift) % nSeg[segRing]
+        dirAngle = dirAngle[segSource]
+        orgAngle = orgAngle[segSource]
+        nPts = nSeg + 1
+        ptRing = np.repeat(np.arange(len(nSeg)), nPts)
+        ptLocal = np.arange(ringOffsets[-1]) - ringOffsets[ptRing]
+        ptShift = shift[ptRing]
+        ptSource = ptLocal - ptShift
+        ptSource[ptSource < 0] += nSeg[ptRing][ptSource < 0]   # First and last points are the same in closed polygons
+        rotatedX = rotatedX[ringOffsets[ptRing] + ptSource]
+        rotatedY = rotatedY[ringOffsets[ptRing] + ptSource]
+        # Find runs of segments with the same orientation
+        # Segments at ~45 degrees are skipped, the last run is closed only when the following segment differs
+        diagonal = (orgAngle % 90 > 30) & (orgAngle % 90 < 60)
+        continues = (dirAngle == dirAngle[segNext]) & ~diagonal[segNext]
+        flush = ~diagonal & ~continues
+        starts = ~diagonal & ((segLocal == 0) | diagonal[segPrev] | flush[segPrev])
+        runFirst = np.maximum.accumulate(np.where(starts, np.arange(len(starts)), 0))
+        runEndSeg = np.flatnonzero(flush)
+        runRing = segRing[runEndSeg]
+        runAxis = np.where(np.isin(dirAngle[runEndSeg], [0, 2]), 0, 1)
+        # Adjust points coodinates by taking the average of points in segment
+        average_segment_runs(rotatedX, rotatedY, ringOffsets, segLocal[runFirst[runEndSeg]], segLocal[runEndSeg], runRing, runAxis)
+        # Reverse shift so we get polygon with the same start/end point as before
+        ptSource = ptLocal + ptShift
+        ptSource[ptSource > nSeg[ptRing]] -= nSeg[ptRing][ptSource > nSeg[ptRing]]
+        ptSource[(ptShift == 0) & (ptLocal == 0)] = nSeg[ptRing][(ptShift == 0) & (ptLocal == 0)]    # Copy updated coordinates to first node
+        rotatedX = rotatedX[ringOffsets[ptRing] + ptSource]
+        rotatedY = rotatedY[ringOffsets[ptRing] + ptSource]
+    with timer(timings, 'rotate'):
+        # Rotate polygon back
+        x, y = rotate(rotatedX, rotatedY, ringOffsets, segOffsets, segStart, -medAngle)
+    if projection is not None:
+        with timer(timings, 'project'):
+            x, y = unproject(x, y)
+    return x, y, corStdev
+
+
+def orthogonalize_polygons(polygons, projection = 'mercator', timings = None):
+    """
+    Batch version of orthogonalize_polygon() for an array of polygons. 
+
+    :Parameters:
+      - `polygons: array of shapely polygon objects containing simplified buildings.
+      - `projection, timings: see orthogonalize_rings().
+
+    :Returns:
+      - polyOrthog: orthogonalized shapely polygons
+      - corStdev: standard deviation of segment angles to closest cardinal direction 
+                  of the exterior ring of each original polygon (NaN for empty and degenerate polygons)
+
+    :Returns Type:
+      numpy arrays
+    """
+    polyOrthog = np.array(polygons, dtype=object)
+    corStdev = np.full(len(polyOrthog), np.nan)
+    # Empty and degenerate parts (no exterior ring with at least 4 coordinates) add no rings to the batch,
+    # they are returned unchanged with NaN stdev, so select_orthogonalized() keeps the original part
+    rings = shapely.get_num_coordinates(shapely.get_exterior_ring(polyOrthog)) >= 4
+    if not rings.any():
+        return polyOrthog, corStdev
+    with timer(timings, 'geometry'):
+        geomType, coords, (ringOffsets, polyOffsets) = shapely.to_ragged_array(polyOrthog[rings], include_z=False)
+    x, y, ringStdev = orthogonalize_rings(coords[:, 0], coords[:, 1], ringOffsets, projection, timings)
+    with timer(timings, 'geometry'):
+        polyOrthog[rings] = shapely.from_ragged_array(geomType, np.column_stack([x, y]), (ringOffsets, polyOffsets))
+    corStdev[rings] = ringStdev[polyOffsets[:-1]]
+    return polyOrthog, corStdev
+
+
+def check_batch(polygons, projection = 'mercator'):
+    """
+    Checks that orthogonalize_polygons() gives the same polygons as orthogonalize_polygon() and that
+    empty and missing parts added to the batch are returned unchanged with NaN stdev.
+
+    :Parameters:
+      - `polygons: array of shapely polygon objects containing simplified buildings.
+
+    :Returns:
+      - number of differences
+
+    :Returns Type:
+      int
+    """
+    polygons = np.array(polygons, dtype=object)
+    degenerate = np.array([Polygon(), None, Polygon()], dtype=object)
+    batch = np.concatenate([polygons[:1], degenerate, polygons[1:]])
+    polyOrthog, corStdev = orthogonalize_polygons(batch, projection)
+    keep = np.ones(len(batch), dtype=bool)
+    keep[1:1 + len(degenerate)] = False
+    reference = np.array([orthogonalize_polygon(polygon) for polygon in polygons], dtype=object)
+    differentPolygons = int((~shapely.equals_exact(polyOrthog[keep], reference, tolerance=1e-9)).sum())
+    differentDegenerate = int(sum(a is not b for a, b in zip(polyOrthog[~keep], degenerate))) + int((~np.isnan(corStdev[~keep])).sum())
+    print("Batch vs. polygon by polygon, " + str(len(polygons)) + " polygons: different polygons " + str(differentPolygons)
+          + ", changed empty/missing parts " + str(differentDegenerate))
+    return differentPolygons + differentDegenerate
+
+
+def profile_projection(polygons, projections = (None, 'mercator', 'local')):
+    """
+    Reports time spent in individual steps of orthogonalize_polygons() for each projection mode
+    and the largest coordinate difference to the reprojecting path (projection=None).
+
+    :Parameters:
+      - `polygons: array of shapely polygon objects containing simplified buildings.
+
+    :Returns:
+      - timings: dictionary of step timings for each projection
+
+    :Returns Type:
+      dict
+    """
+    timings = {}
+    reference = None
+    for projection in projections:
+        timings[projection] = {}
+        polyOrthog, corStdev = orthogonalize_polygons(polygons, projection, timings[projection])
+        report_timings(timings[projection], "projection=" + str(projection))
+        coords = shapely.get_coordinates(polyOrthog)
+        if reference is None:
+            reference = coords
+        else:
+            print("  max. difference to reprojecting path: " + str(np.abs(coords - reference).max()) + " deg")
+    return timings
+
+
+def repair_geometry(geoms):
+    """
+    Returns copy of geometry array where invalid geometries are replaced by shapely.make_valid().
+    """
+    geoms = np.array(geoms, dtype=object)
+    invalid = ~shapely.is_valid(geoms)
+    if invalid.any():
+        geoms[invalid] = shapely.make_valid(geoms[invalid])
+    return geoms
+
+
+def select_orthogonalized(geometry, parts, partBuilding, partsOrtho, partsStdev, minRetention = MIN_RETENTION, maxStdev = MAX_STDEV):
+    """
+    Decides for all polygon parts of a slice at once whether to keep orthogonalized or original shape.
+    Orthogonalized part is rejected when it does not intersect the original part, or when the
+    intersection retains less than minRetention of the building area and the original segments
+    deviate from cardinal directions by more than maxStdev degrees.
+
+    :Parameters:
+      - `geometry: array of shapely (Multi)Polygons of simplified buildings.
+      - `parts, partBuilding: polygon parts of buildings and index of their building (shapely.get_parts).
+      - `partsOrtho, partsStdev: orthogonalized parts and stdev of their angles (orthogonalize_polygons).
+      - `minRetention: minimal share of original area kept by orthogonalized part.
+      - `maxStdev: angle deviation in degrees above which low retention parts are rejected.
+
+    :Returns:
+      - geometry: buildings with accepted parts
+      - percChange: retained area share, for multipolygons of the last intersecting part (NaN if none)
+
+    :Returns Type:
+      numpy arrays
+    """
+    geometry = np.array(geometry, dtype=object)
+    interArea = shapely.area(shapely.intersection(repair_geometry(partsOrtho), repair_geometry(parts)))
+    retention = np.round(interArea / shapely.area(geometry)[partBuilding], 3)
+    intersects = interArea > 0
+    accept = intersects & ~((retention < minRetention) & (partsStdev > maxStdev))
+    chosen = np.where(accept, partsOrtho, parts)
+    # Value of the last intersecting part of each building
+    percChange = np.full(len(geometry), np.nan)
+    lastBuilding, lastPart = np.unique(partBuilding[intersects][::-1], return_index=True)
+    percChange[lastBuilding] = retention[intersects][::-1][lastPart]
+    # Reassemble buildings from the chosen parts
+    multi = shapely.get_type_id(geometry) == shapely.GeometryType.MULTIPOLYGON
+    partMulti = multi[partBuilding]
+    geometry[partBuilding[~partMulti]] = chosen[~partMulti]
+    multiIds = np.flatnonzero(multi)
+    if len(multiIds) > 0:
+        geometry[multiIds] = shapely.multipolygons(chosen[partMulti], indices=np.searchsorted(multiIds, partBuilding[partMulti]))
+    return geometry, percChange
+
+
+def select_orthogonalized_overlay(geometry, parts, partBuilding, partsOrtho, partsStdev, minRetention = MIN_RETENTION, maxStdev = MAX_STDEV):
+    """
+    Reference implementation of select_orthogonalized() that runs gpd.overlay() for every part.
+    Used only for benchmarking (see benchmark_selection).
+    """
+    geometry = np.array(geometry, dtype=object)
+    percChange = np.full(len(geometry), np.nan)
+    part = 0
+    for i in range(0, len(geometry)):
+        build = geometry[i]
+        buildParts = list(build.geoms) if build.geom_type == 'MultiPolygon' else [build]
+        chosen = []
+        for poly in buildParts:
+            buildOrtho = partsOrtho[part]
+            corStdev = partsStdev[part]
+            part += 1
+            x = gpd.overlay(gpd.GeoDataFrame({'geometry':[buildOrtho]}, crs="EPSG:4326"), gpd.GeoDataFrame({'geometry':[poly]}, crs="EPSG:4326"), how='intersection')
             if len(x) > 0:
-                buildings.loc[i, 'perc.change'] = round( x.loc[0, 'geometry'].area/buildings.loc[i, 'geometry'].area, 3)
-                if buildings.loc[i, 'perc.change'] < 0.95:
-                    orgAngle, corAngle, dirAngle = calculate_segment_angles(poly)
-                    if statistics.stdev(corAngle) > 9:
-                        multipolygon.append(poly)
-                        continue 
+                percChange[i] = round( x.loc[0, 'geometry'].area/build.area, 3)
+                if percChange[i] < minRetention and corStdev > maxStdev:
+                    chosen.append(poly)
+                    continue
+                chosen.append(buildOrtho)
             else:
-                multipolygon.append(poly)
-                continue
-            multipolygon.append(buildOrtho)
-        buildings.loc[i, 'geometry'] = gpd.GeoSeries(MultiPolygon(multipolygon)).values # Workaround for Pandas/Geopandas bug
-        # buildings.loc[i, 'geometry'] = MultiPolygon(multipolygon)   # Does not work
-    else:    
-        # Orthogonalize
-        buildOrtho = orthogonalize_polygon(build)
-        x = gpd.overlay(gpd.GeoDataFrame({'geometry':[buildOrtho]}, crs="EPSG:4326").loc[0:0], buildings.loc[i:i], how='intersection')
-        if len(x) > 0:
-            buildings.loc[i, 'perc.change'] = round( x.loc[0, 'geometry'].area/buildings.loc[i, 'geometry'].area, 3)
-            if buildings.loc[i, 'perc.change'] < 0.95:
-                orgAngle, corAngle, dirAngle = calculate_segment_angles(build)
-                if statistics.stdev(corAngle) > 9:
-                    continue       
-            buildings.loc[i, 'geometry'] = buildOrtho
-    
-
-buildings['geometry'] = buildings['geometry'].simplify(0.000001, preserve_topology=True)
-
-buildings.to_file('/Buildigns_footprints_testing/ortho/BuildCT_ortho_' + str(sliceNo) + '.geojson', driver='GeoJSON')
+                chosen.append(poly)
+        geometry[i] = MultiPolygon(chosen) if build.geom_type == 'MultiPolygon' else chosen[0]
+    return geometry, percChange
+
+
+def benchmark_selection(geometry, parts, partBuilding, partsOrtho, partsStdev):
+    """
+    Compares run time and results of select_orthogonalized() and select_orthogonalized_overlay().
+    """
+    timings = {}
+    with timer(timings, 'overlay'):
+        geomOverlay, percOverlay = select_orthogonalized_overlay(geometry, parts, partBuilding, partsOrtho, partsStdev)
+    with timer(timings, 'vectorized'):
+        geomVector, percVector = select_orthogonalized(geometry, parts, partBuilding, partsOrtho, partsStdev)
+    report_timings(timings, "Area retention check of " + str(len(geometry)) + " buildings")
+    print("  speedup: " + str(round(timings['overlay'] / timings['vectorized'], 1)) + "x")
+    print("  different perc.change: " + str(int((~np.isclose(percOverlay, percVector, atol=0.001, equal_nan=True)).sum())))
+    print("  different geometry: " + str(int((~shapely.equals_exact(geomOverlay, geomVector)).sum())))
+    return timings
+
+
+def read_features(source, start, stop):
+    """
+    Reads features start ... stop-1 of a vector file.
+    Features are read with OGR random access (for shapefiles through the .shx offset index),
+    so only the requested records are read no matter where in the file they are.
+
+    :Returns:
+      - buildings: GeoDataFrame in EPSG:4326 with index starting from 0
+
+    :Returns Type:
+      GeoDataFrame
+    """
+    buildings = gpd.read_file(source, engine='pyogrio', skip_features=start, max_features=stop - start)
+    buildings.crs = "EPSG:4326"
+    return buildings
+
+
+def orthogonalize_buildings(buildings, timings = None, cache = None, cacheStats = None):
+    """
+    Simplifies and orthogonalizes all buildings of a GeoDataFrame.
+
+    :Parameters:
+      - `buildings: GeoDataFrame of building footprints in EPSG:4326.
+      - `timings: optional dictionary that collects time spent in individual steps.
+      - `cache: optional connection to ortho cache (see ortho_cache.py). Only buildings that are not
+                in the cache are orthogonalized, their results are added to the cache.
+      - `cacheStats: optional dictionary, numbers of cache 'hits' and 'misses' are added to it,
+                     buildings without geometry are never cached and are counted as 'skipped'.
+
+    :Returns:
+      - buildings: copy with orthogonalized geometry and 'perc.change' column
+
+    :Returns Type:
+      GeoDataFrame
+    """
+    if cache is not None:
+        return orthogonalize_buildings_cached(buildings, cache, timings, cacheStats)
+    buildings = buildings.copy()
+    with timer(timings, 'simplify'):
+        buildings['geometry'] = buildings['geometry'].simplify(SIMPLIFY_TOLERANCE, preserve_topology=True)
+    # Orthogonalize all polygons (including MultiPolygon parts) in one batch
+    # Coordinates are projected to Mercator once for the whole batch
+    parts, partBuilding = shapely.get_parts(buildings['geometry'].values, return_index=True)
+    partsOrtho, partsStdev = orthogonalize_polygons(parts, 'mercator', timings)
+    # Keep original shape of parts that lost too much area and are not rectangular
+    with timer(timings, 'area retention'):
+        geometry, percChange = select_orthogonalized(buildings['geometry'].values, parts, partBuilding, partsOrtho, partsStdev)
+    buildings['geometry'] = geometry
+    buildings['perc.change'] = percChange
+    with timer(timings, 'simplify'):
+        buildings['geometry'] = buildings['geometry'].simplify(FINAL_SIMPLIFY_TOLERANCE, preserve_topology=True)
+    return buildings
+
+
+def orthogonalize_buildings_cached(buildings, cache, timings = None, cacheStats = None):
+    """
+    orthogonalize_buildings() that takes results of unchanged buildings from the cache.
+    Buildings are looked up by hash of their input geometry and ORTHO_PARAMETERS in one query.
+    """
+    with timer(timings, 'cache lookup'):
+        keys = cache_keys(buildings['geometry'].values, ORTHO_PARAMETERS)
+        geometry, percChange, hit = cache_get(cache, keys)
+    miss = ~hit
+    skipped = pd.isnull(keys)
+    if miss.any():
+        computed = orthogonalize_buildings(buildings.iloc[np.flatnonzero(miss)], timings)
+        geometry[miss] = np.asarray(computed['geometry'].values, dtype=object)
+        percChange[miss] = computed['perc.change'].values
+        with timer(timings, 'cache store'):
+            cache_put(cache, keys[miss], geometry[miss], percChange[miss])
+    if cacheStats is not None:
+        cacheStats['hits'] = cacheStats.get('hits', 0) + int(hit.sum())
+        cacheStats['misses'] = cacheStats.get('misses', 0) + int((miss & ~skipped).sum())
+        cacheStats['skipped'] = cacheStats.get('skipped', 0) + int(skipped.sum())
+    buildings = buildings.copy()
+    buildings['geometry'] = geometry
+    buildings['perc.change'] = percChange
+    return buildings
+
+
+#### Main Part
+# Processes one slice of 50000 buildings: python orthogonalize.py <sliceNo>
+# For processing of the whole state use orthogonalize_parallel.py
+
+if __name__ == "__main__":
+    import sys
+
+    args = sys.argv
+    sliceNo = int(args[1])
+    timings = {}
+    with timer(timings, 'read'):
+        buildings = read_features('/Buildigns_footprints_testing/geo_export_98ca6254-03aa-48e1-8931-a446a182959c.shp', sliceNo*50000, (sliceNo+1)*50000)
+
+    save_stage(buildings, '/Buildigns_footprints_testing/raw/BuildCT_raw_' + str(sliceNo))
 
+    buildings = orthogonalize_buildings(buildings, timings)
+    report_timings(timings, "Slice " + str(sliceNo) + " orthogonalization")
 
+    save_stage(buildings, '/Buildigns_footprints_testing/ortho/BuildCT_ortho_' + str(sliceNo))
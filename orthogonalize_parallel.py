@@ -0,0 +1,146 @@
+# Orthogonalize all CT buildings in parallel on all CPU cores
+# Replaces running 30 copies of orthogonalize.py in fixed batches (process_CT_build.sh).
+# Source is split into small chunks that are handed to free workers as they finish,
+# so one slow chunk does not hold back the others. Each worker reads only its own records
+# (random access through the shapefile .shx index), so read time does not grow with chunk position.
+# Workers return raw and orthogonalized chunks, so the source is read only once.
+# Outputs are the same 30 slices of 50000 buildings (raw/BuildCT_raw_N, ortho/BuildCT_ortho_N,
+# see storage.py for format) that merge_CT.py reads.
+# Results of buildings are cached (ortho_cache.py), so a rerun on a new data release
+# orthogonalizes only changed buildings.
+#
+# Usage: python orthogonalize_parallel.py [--workers N] [--chunk-size N] [--cache PATH | --no-cache] [--cache-size GB]
+
+import geopandas as gpd
+import pandas as pd
+import os
+import time
+import argparse
+import pyogrio
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from orthogonalize import orthogonalize_buildings, read_features
+from timing import timer, report_timings
+from storage import save_stage, report_storage
+from ortho_cache import CACHE_PATH, MAX_BYTES, open_cache, evict, report_cache
+
+
+SOURCE = '/Buildigns_footprints_testing/geo_export_98ca6254-03aa-48e1-8931-a446a182959c.shp'
+OUTDIR = '/Buildigns_footprints_testing'
+SLICE_SIZE = 50000
+
+
+def make_chunks(nFeatures, sliceSize = SLICE_SIZE, chunkSize = 2000):
+    """
+    Splits feature range into chunks that never cross slice boundaries.
+
+    :Returns:
+      - chunks: list of (chunkNo, sliceNo, start, stop)
+
+    :Returns Type:
+      list
+    """
+    chunks = []
+    for sliceStart in range(0, nFeatures, sliceSize):
+        sliceStop = min(sliceStart + sliceSize, nFeatures)
+        for start in range(sliceStart, sliceStop, chunkSize):
+            chunks.append((len(chunks), sliceStart // sliceSize, start, min(start + chunkSize, sliceStop)))
+    return chunks
+
+
+def orthogonalize_chunk(chunkNo, source, start, stop, cachePath = None):
+    """
+    Worker function. Reads and orthogonalizes one chunk and measures time spent in each step.
+    With cachePath, cached results are used for unchanged buildings.
+
+    :Returns:
+      - chunkNo, raw buildings, orthogonalized buildings, step timings, total seconds, cache hits and misses
+
+    :Returns Type:
+      tuple
+    """
+    startTime = time.perf_counter()
+    timings = {}
+    cacheStats = {}
+    with timer(timings, 'read'):
+        raw = read_features(source, start, stop)
+    if cachePath is None:
+        buildings = orthogonalize_buildings(raw, timings)
+    else:
+        cache = open_cache(cachePath)
+        buildings = orthogonalize_buildings(raw, timings, cache, cacheStats)
+        cache.close()
+    return chunkNo, raw, buildings, timings, time.perf_counter() - startTime, cacheStats
+
+
+def write_slice(parts, path):
+    """
+    Concatenates chunks of one slice in their original order and saves them.
+    """
+    buildings = pd.concat(parts, ignore_index=True).pipe(gpd.GeoDataFrame)
+    buildings.crs = "EPSG:4326"
+    save_stage(buildings, path)
+
+
+def run(source = SOURCE, outdir = OUTDIR, workers = None, chunkSize = 2000, cachePath = CACHE_PATH, cacheBytes = MAX_BYTES):
+    workers = workers or os.cpu_count()
+    os.makedirs(os.path.join(outdir, 'raw'), exist_ok=True)
+    os.makedirs(os.path.join(outdir, 'ortho'), exist_ok=True)
+
+    nFeatures = pyogrio.read_info(source)['features']
+    chunks = make_chunks(nFeatures, SLICE_SIZE, chunkSize)
+    slices = sorted(set(c[1] for c in chunks))
+    print("Orthogonalizing " + str(nFeatures) + " buildings in " + str(len(chunks)) + " chunks on " + str(workers) + " workers")
+
+    # Slice results are collected per chunk and a slice is written as soon as all its chunks are done
+    rawResults = {}
+    results = {}
+    remaining = {s: sum(1 for c in chunks if c[1] == s) for s in slices}
+    timings = {}
+    cacheStats = {'hits': 0, 'misses': 0, 'skipped': 0}
+    chunkTimes = []
+    startTime = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(orthogonalize_chunk, chunkNo, source, start, stop, cachePath) for chunkNo, sliceNo, start, stop in chunks]
+        for done, future in enumerate(as_completed(futures), start=1):
+            chunkNo, rawPart, part, chunkTimings, seconds, chunkCache = future.result()
+            chunkTimes.append(seconds)
+            for name, value in chunkCache.items():
+                cacheStats[name] += value
+            for name, value in chunkTimings.items():
+                timings[name] = timings.get(name, 0.0) + value
+            sliceNo, start, stop = chunks[chunkNo][1:]
+            rawResults[chunkNo] = rawPart
+            results[chunkNo] = part
+            elapsed = time.perf_counter() - startTime
+            print("[" + str(done) + "/" + str(len(chunks)) + "] chunk " + str(chunkNo) + " (features " + str(start) + "-" + str(stop) + ") "
+                  + str(round(seconds, 2)) + " s, elapsed " + str(round(elapsed)) + " s, ETA " + str(round(elapsed / done * (len(chunks) - done))) + " s")
+            remaining[sliceNo] -= 1
+            if remaining[sliceNo] == 0:
+                sliceChunks = [c[0] for c in chunks if c[1] == sliceNo]
+                write_slice([rawResults.pop(c) for c in sliceChunks], os.path.join(outdir, 'raw', 'BuildCT_raw_' + str(sliceNo)))
+                write_slice([results.pop(c) for c in sliceChunks], os.path.join(outdir, 'ortho', 'BuildCT_ortho_' + str(sliceNo)))
+
+    report_timings(timings, "CPU time of reading and orthogonalization steps summed over workers")
+    print("Chunk time: min " + str(round(min(chunkTimes), 2)) + " s, mean " + str(round(sum(chunkTimes) / len(chunkTimes), 2))
+          + " s, max " + str(round(max(chunkTimes), 2)) + " s")
+    if cachePath is not None:
+        cache = open_cache(cachePath)
+        removed = evict(cache, cacheBytes)
+        report_cache(cacheStats['hits'], cacheStats['misses'], cache, cacheStats['skipped'])
+        print("  evicted " + str(removed) + " least recently used entries (limit " + str(round(cacheBytes / 2**30, 1)) + " GB)")
+        cache.close()
+    report_storage()
+    print("Wall time: " + str(round(time.perf_counter() - startTime, 1)) + " s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Orthogonalize CT buildings in parallel")
+    parser.add_argument('--source', default=SOURCE)
+    parser.add_argument('--outdir', default=OUTDIR)
+    parser.add_argument('--workers', type=int, default=None, help="number of processes (default: all CPU cores)")
+    parser.add_argument('--chunk-size', type=int, default=2000, help="buildings per task")
+    parser.add_argument('--cache', default=CACHE_PATH, help="cache of orthogonalized buildings (SQLite)")
+    parser.add_argument('--no-cache', action='store_true', help="orthogonalize all buildings without cache")
+    parser.add_argument('--cache-size', type=float, default=MAX_BYTES / 2**30, help="maximum size of cached geometries in GB")
+    args = parser.parse_args()
+    run(args.source, args.outdir, args.workers, args.chunk_size, None if args.no_cache else args.cache, int(args.cache_size * 2**30))
@@ -0,0 +1,199 @@
+# Offline source of OSM buildings, addresses and town boundaries
+# Reads a local extract (.osm.pbf, e.g. connecticut-latest.osm.pbf from Geofabrik) instead of querying Overpass.
+# Extract is converted to GeoParquet once and later runs read the cache at local disk speed.
+# Cache entries are keyed by path, size and modification time of their sources, so a new extract
+# is converted again automatically. Cache directory can be changed with environment variable CT_IMPORT_CACHE.
+# GeoParquet/GeoJSON sources (e.g. output of previous runs) are read directly.
+
+import geopandas as gpd
+import pandas as pd
+import shapely
+import pyogrio
+import hashlib
+import os
+import re
+import time
+
+
+CACHE_DIR = os.environ.get('CT_IMPORT_CACHE', os.path.expanduser('~/.cache/ct_import'))
+
+ADDRESS_TAGS = ['addr:city', 'addr:housenumber', 'addr:street', 'addr:postcode', 'addr:unit']
+
+
+def source_key(*paths):
+    """
+    Fingerprint of source files: path, size and modification time.
+
+    :Returns Type:
+      str
+    """
+    text = ';'.join(os.path.abspath(p) + ':' + str(os.path.getsize(p)) + ':' + str(os.path.getmtime(p)) for p in paths)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def cached(name, key, build):
+    """
+    Returns cached result of build() saved as Parquet under name and key, builds and saves it if missing.
+
+    :Parameters:
+      - `name: name of the cached dataset, e.g. 'buildings'
+      - `key: fingerprint of the sources (see source_key)
+      - `build: function without parameters returning (Geo)DataFrame
+
+    :Returns Type:
+      GeoDataFrame or DataFrame
+    """
+    path = os.path.join(CACHE_DIR, name + '-' + key + '.parquet')
+    start = time.perf_counter()
+    if os.path.exists(path):
+        try:
+            frame = gpd.read_parquet(path)
+        except ValueError:
+            # Cached table without geometry
+            frame = pd.read_parquet(path)
+        print("Loaded cached " + name + ": " + str(len(frame)) + " rows in " + str(round(time.perf_counter() - start, 2)) + " s")
+        return frame
+    frame = build()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Written atomically, interrupted run does not leave a broken cache entry
+    frame.to_parquet(path + '.tmp')
+    os.replace(path + '.tmp', path)
+    print("Built " + name + ": " + str(len(frame)) + " rows in " + str(round(time.perf_counter() - start, 2)) + " s")
+    return frame
+
+
+def extract_tags(otherTags, tags):
+    """
+    Extracts tags from OGR OSM driver 'other_tags' column ("key"=>"value",...) with one regex per tag over the whole column.
+
+    :Returns:
+      one column per tag, missing tags are None
+
+    :Returns Type:
+      DataFrame
+    """
+    otherTags = pd.Series(otherTags, dtype=object)
+    columns = {}
+    for tag in tags:
+        values = otherTags.str.extract('"' + re.escape(tag) + r'"=>"((?:[^"\\]|\\.)*)"', expand=False)
+        values = values.str.replace(r'\\(.)', r'\1', regex=True)
+        columns[tag] = values.astype(object).where(values.notnull(), None)
+    return pd.DataFrame(columns, index=otherTags.index)
+
+
+def read_pbf(source, layer, where = None):
+    """
+    Reads one layer of OSM extract with OGR OSM driver. OSM data are always in EPSG:4326.
+    """
+    return pyogrio.read_dataframe(source, layer=layer, where=where).set_crs("EPSG:4326", allow_override=True)
+
+
+def read_local(source):
+    """
+    Reads GeoParquet or any file readable by GDAL.
+    """
+    if source.endswith('.parquet'):
+        return gpd.read_parquet(source)
+    return gpd.read_file(source)
+
+
+def is_osm(source):
+    return source.endswith('.pbf') or source.endswith('.osm')
+
+
+def load_buildings(source):
+    """
+    Loads building polygons and multipolygons (closed ways and relations with building tag).
+
+    :Returns:
+      - buildings with columns osm_id, building, geometry in EPSG:4326
+
+    :Returns Type:
+      GeoDataFrame
+    """
+    if not is_osm(source):
+        return read_local(source)
+
+    def build():
+        buildings = read_pbf(source, 'multipolygons', "building IS NOT NULL")
+        buildings['osm_id'] = buildings['osm_id'].fillna(buildings['osm_way_id'])
+        return buildings[['osm_id', 'building', 'geometry']].reset_index(drop=True)
+
+    return cached('buildings', source_key(source), build)
+
+
+def load_addresses(source):
+    """
+    Loads all nodes, ways and relations with addr:housenumber. Ways and relations are replaced by centroids.
+
+    :Returns:
+      - addresses with columns osm_id, ADDRESS_TAGS, geometry in EPSG:4326
+
+    :Returns Type:
+      GeoDataFrame
+    """
+    if not is_osm(source):
+        return read_local(source)
+
+    def build():
+        where = "other_tags LIKE '%\"addr:housenumber\"%'"
+        points = read_pbf(source, 'points', where)
+        polygons = read_pbf(source, 'multipolygons', where)
+        polygons['osm_id'] = polygons['osm_id'].fillna(polygons['osm_way_id'])
+        polygons['geometry'] = shapely.centroid(shapely.make_valid(polygons.geometry.values))
+        parts = []
+        for part in [polygons, points]:
+            tags = extract_tags(part['other_tags'], ADDRESS_TAGS)
+            parts.append(gpd.GeoDataFrame(pd.concat([part[['osm_id']], tags], axis=1), geometry=part.geometry.values, crs="EPSG:4326"))
+        return pd.concat(parts, ignore_index=True).pipe(gpd.GeoDataFrame)
+
+    return cached('addresses', source_key(source), build)
+
+
+def load_towns(source, adminLevel = 8):
+    """
+    Loads town boundaries (administrative boundaries of admin_level 8 in CT).
+
+    :Returns:
+      - towns with columns town_name, geometry in EPSG:4326
+
+    :Returns Type:
+      GeoDataFrame
+    """
+    if not is_osm(source):
+        return read_local(source)
+
+    def build():
+        towns = read_pbf(source, 'multipolygons', "boundary = 'administrative' AND admin_level = '" + str(adminLevel) + "'")
+        return towns[['name', 'geometry']].rename(columns={'name': 'town_name'}).reset_index(drop=True)
+
+    return cached('towns-' + str(adminLevel), source_key(source), build)
+
+
+def town_building_index(addresses, buildings, key, margin = 100):
+    """
+    Per-town index of buildings: for every town (addr:city) positions of buildings within the bounding box
+    of its addresses extended by margin. Built with one spatial index of all buildings and cached.
+    Addresses without addr:city are one town with empty name.
+
+    :Parameters:
+      - `addresses: address points in metric CRS with column 'addr:city'
+      - `buildings: buildings in the same CRS
+      - `key: fingerprint of address and building sources (see source_key)
+      - `margin: extension of bounding boxes in CRS units
+
+    :Returns:
+      - index: columns town, building (position in buildings), sorted by town and building
+
+    :Returns Type:
+      DataFrame
+    """
+    def build():
+        tree = shapely.STRtree(buildings.geometry.values)
+        bounds = addresses.geometry.bounds.groupby(addresses['addr:city'].fillna('').values).agg({'minx': 'min', 'miny': 'min', 'maxx': 'max', 'maxy': 'max'})
+        areas = shapely.buffer(shapely.box(bounds['minx'], bounds['miny'], bounds['maxx'], bounds['maxy']), margin)
+        townIdx, buildIdx = tree.query(areas)
+        index = pd.DataFrame({'town': bounds.index.values[townIdx], 'building': buildIdx})
+        return index.sort_values(['town', 'building']).reset_index(drop=True)
+
+    return cached('town-buildings-' + str(margin), key, build)
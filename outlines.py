@@ -0,0 +1,119 @@
+# Building outlines from groups of touching building:part polygons (e.g. building with attached decks)
+# Touching pairs come from one bulk spatial index query and groups are connected components
+# of the touching graph, so each outline is a union of only a few polygons.
+# Usable for any dataset with part-level polygons (see build_outlines).
+
+import numpy as np
+import shapely
+import os
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+def touching_pairs(geometries, others = None):
+    """
+    Finds all pairs of intersecting polygons with one bulk query of spatial index (STRtree).
+
+    :Parameters:
+      - `geometries: array of geometries
+      - `others: array of geometries that are tested against geometries. Default: geometries themselves
+
+    :Returns:
+      - left, right: positions of intersecting geometries in others and geometries
+
+    :Returns Type:
+      tuple
+    """
+    tree = shapely.STRtree(geometries)
+    return tree.query(geometries if others is None else others, predicate='intersects')
+
+
+def connected_components(n, left, right):
+    """
+    Labels connected components of undirected graph given by edges left[i] - right[i].
+    Every node takes the smallest label of its neighbours until nothing changes.
+
+    :Parameters:
+      - `n: number of nodes
+      - `left, right: node positions of edges
+
+    :Returns:
+      - component: component number of every node, numbered 0.. in order of their first node
+
+    :Returns Type:
+      numpy array
+    """
+    labels = np.arange(n)
+    while True:
+        new = labels.copy()
+        np.minimum.at(new, left, labels[right])
+        np.minimum.at(new, right, labels[left])
+        # Label of a node is a node of the same component with smaller label, jump to its label
+        new = new[new]
+        if (new == labels).all():
+            break
+        labels = new
+    return np.unique(labels, return_inverse=True)[1]
+
+
+def _union_components(geometries, groups):
+    """
+    Worker function. Unions polygons of each group and assigns every member to the outline polygon it lies in.
+    Members touching only in a point end up in different outline polygons.
+
+    :Returns:
+      - list of (outline polygon, member positions)
+
+    :Returns Type:
+      list
+    """
+    result = []
+    for members in groups:
+        pieces = shapely.get_parts(shapely.union_all(geometries[members]))
+        if len(pieces) == 1:
+            result.append((pieces[0], members))
+            continue
+        # Interior point of a member lies only in the piece that contains the member
+        inside = shapely.covers(pieces[:, np.newaxis], shapely.point_on_surface(geometries[members])[np.newaxis, :])
+        for k, piece in enumerate(pieces):
+            result.append((piece, members[inside[k]]))
+    return result
+
+
+def build_outlines(geometries, workers = None, chunkSize = 500):
+    """
+    Builds building outlines of touching building:part polygons (e.g. house with attached decks).
+    Parts are grouped by the touching graph and each group is unioned independently on a thread pool
+    (GEOS releases the GIL). Membership of parts is tracked explicitly, so a part that does not touch
+    any other part (e.g. lone deck) is recognized without comparing geometries.
+
+    :Parameters:
+      - `geometries: array of valid polygons
+      - `workers: number of threads. Default: number of CPU cores
+      - `chunkSize: number of groups unioned in one task
+
+    :Returns:
+      - outlines: array of outline polygons, each made of at least 2 parts
+      - membership: position of outline for every part, -1 for parts that stand alone
+
+    :Returns Type:
+      tuple
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    left, right = touching_pairs(geometries)
+    component = connected_components(len(geometries), left, right)
+    order = np.argsort(component, kind='stable')
+    starts = np.flatnonzero(np.diff(component[order])) + 1
+    groups = [members for members in np.split(order, starts) if len(members) > 1]
+    chunks = [groups[i:i + chunkSize] for i in range(0, len(groups), chunkSize)]
+
+    outlines = []
+    membership = np.full(len(geometries), -1, dtype=np.int64)
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for result in pool.map(functools.partial(_union_components, geometries), chunks):
+            for piece, members in result:
+                if len(members) < 2:
+                    continue
+                membership[members] = len(outlines)
+                outlines.append(piece)
+    return np.array(outlines, dtype=object), membership
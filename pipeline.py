@@ -0,0 +1,240 @@
+# Incremental rebuild of the whole pipeline (README steps 1-4, NAD addresses and town parsers)
+# Every stage is fingerprinted by content of its input files (including data tables of this repository like
+# location_exceptions.csv), its code (script and local modules it imports, so also simplify tolerances, grid size
+# and other constants) and its command line. A stage runs only when its fingerprint changed or its outputs are
+# missing or modified, so after a change of one source only the stages that depend on it are rebuilt.
+# Stages run in the order they are listed. Stages with missing inputs (e.g. town sources that are not
+# downloaded) are skipped.
+# Content hashes of files are cached by size and modification time, unchanged files are not read again.
+#
+# Usage: python pipeline.py [--dry-run] [--force STAGE ...] [--only STAGE ...]
+
+import hashlib
+import json
+import os
+import sys
+import ast
+import time
+import argparse
+import subprocess
+from storage import stage_path
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATE = os.path.join(os.environ.get('CT_IMPORT_CACHE', os.path.expanduser('~/.cache/ct_import')), 'pipeline-state.json')
+DATA = '/Buildigns_footprints_testing'
+NAD = os.path.expanduser('~/Desktop/Buildings/NAD_address/NAD_r6_TXT/TXT')
+
+
+def shapefile(path):
+    """
+    Shapefile with its sidecar files (.shx, .dbf, .prj, .cpg).
+    """
+    base = os.path.splitext(path)[0]
+    return [path] + [base + extension for extension in ['.shx', '.dbf', '.prj', '.cpg'] if os.path.exists(base + extension)]
+
+
+# Stages of the pipeline: (name, command, inputs, outputs)
+# Data tables read by the code are listed as inputs, code fingerprints follow only imports of .py modules.
+# Orthogonalized slices are checked and copied to Processed1/Processed_good by hand before merging,
+# so merge_CT.py depends on the copied slices, not directly on orthogonalize_parallel.py.
+STAGES = [
+    ('orthogonalize', ['orthogonalize_parallel.py'],
+     shapefile(DATA + '/geo_export_98ca6254-03aa-48e1-8931-a446a182959c.shp'),
+     [stage_path(DATA + '/ortho/BuildCT_ortho_' + str(i)) for i in range(30)]),
+    ('hartford', ['process_Hartford_data.py'],
+     shapefile(DATA + '/Hartford/Building-shp/Building.shp'),
+     [stage_path(DATA + '/Hartford/Building-shp/Hartford_buildings_parsedSimp1')]),
+    ('address', ['process_CT_address.py'],
+     shapefile(DATA + '/Address/Connecticut_Buildings_with_Addresses_experimental.shp') + [os.path.join(ROOT, 'location_exceptions.csv')],
+     [stage_path(DATA + '/Address/CTAddressAll-parsed'), stage_path(DATA + '/Address/CTAddressDedup-parsed')]),
+    ('merge', ['merge_CT.py'],
+     [stage_path(DATA + '/Processed1/Processed_good/BuildCT_ortho_' + str(i)) for i in range(30)]
+     + [stage_path(DATA + '/Hartford/Building-shp/Hartford_buildings_parsedSimp1'), stage_path(DATA + '/Address/CTAddressDedup-parsed'),
+        DATA + '/boundaries/Hartford.geojson', DATA + '/boundaries/CTnoWestCOG.geojson'],
+     [DATA + '/CTBuildingsAddressAll.geojson', DATA + '/grid.geojson', DATA + '/gridFinal.geojson']),
+    ('nad', ['process_NAD_address.py'],
+     [NAD + '/NAD_r6_CT_header.csv', NAD + '/Zip Code Tabulation Area Boundaries.geojson', os.path.join(ROOT, 'nad_unit_fixes.csv')],
+     [NAD + '/CT-address.geojson']),
+    ('snap', ['snap_NAD_address_to_building.py'],
+     [NAD + '/CT-address.geojson', os.path.expanduser('~/Desktop/Buildings/OSM/connecticut-latest.osm.pbf')],
+     [NAD + '/CT-address-IterSnapped.geojson']),
+    ('glastonbury', ['Glastonbury_parse.py'],
+     ['/Users/Desktop/Buildings/Glastonbury/Glastonbury Buildings.geojson'],
+     ['/Users/Desktop/Buildings/Glastonbury/Glastonbury-parsed.geojson']),
+    ('stonington', ['Stonington_parse.py'],
+     shapefile('/Users/Desktop/Buildings/Stonington/stonington-buildings.shp'),
+     ['/Users/Desktop/Buildings/Stonington/Stonington-parsed.geojson']),
+]
+
+
+def load_state(path = STATE):
+    if not os.path.exists(path):
+        return {'files': {}, 'stages': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(state, path = STATE):
+    """
+    Writes state atomically, interrupted run keeps the previous state.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def file_hash(path, state):
+    """
+    SHA-256 of file content. Hash is reused while size and modification time of the file stay the same.
+
+    :Returns:
+      - hash, None if the file does not exist
+
+    :Returns Type:
+      str
+    """
+    if not os.path.exists(path):
+        return None
+    info = os.stat(path)
+    cached = state['files'].get(path)
+    if cached is not None and cached[0] == info.st_size and cached[1] == info.st_mtime_ns:
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+    state['files'][path] = [info.st_size, info.st_mtime_ns, digest.hexdigest()]
+    return digest.hexdigest()
+
+
+def local_modules(script, root = ROOT):
+    """
+    Script and all modules of this repository it imports (directly or through other local modules).
+
+    :Returns:
+      - paths sorted by name
+
+    :Returns Type:
+      list
+    """
+    found = set()
+    pending = [os.path.join(root, script)]
+    while pending:
+        path = pending.pop()
+        if path in found:
+            continue
+        found.add(path)
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module is not None:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module = os.path.join(root, name.split('.')[0] + '.py')
+                if os.path.exists(module):
+                    pending.append(module)
+    return sorted(found)
+
+
+def fingerprint(command, inputs, state, root = ROOT):
+    """
+    Fingerprint of one stage: command line, content of inputs and code, and format of intermediate files.
+
+    :Returns:
+      - fingerprint, list of missing inputs
+
+    :Returns Type:
+      tuple
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps(command).encode())
+    digest.update(os.environ.get('CT_IMPORT_FORMAT', 'parquet').encode())
+    missing = []
+    for path in list(inputs) + local_modules(command[0], root):
+        value = file_hash(path, state)
+        if value is None:
+            missing.append(path)
+        digest.update((path + ':' + str(value) + ';').encode())
+    return digest.hexdigest(), missing
+
+
+def is_current(name, stageFingerprint, outputs, state):
+    """
+    Stage is current when it was last run with the same fingerprint and its outputs were not changed since.
+    """
+    previous = state['stages'].get(name)
+    if previous is None or previous['fingerprint'] != stageFingerprint:
+        return False
+    for path in outputs:
+        value = file_hash(path, state)
+        if value is None or value != previous['outputs'].get(path):
+            return False
+    return True
+
+
+def run(stages = STAGES, statePath = STATE, only = None, force = (), dryRun = False, root = ROOT):
+    """
+    Runs stages that are not current, in the order of stages.
+
+    :Parameters:
+      - `stages: list of (name, command, inputs, outputs), command is script and its arguments
+      - `statePath: json file with fingerprints of finished stages and cached file hashes
+      - `only: names of stages to consider, default all
+      - `force: names of stages that run even if they are current
+      - `dryRun: only print which stages would run
+
+    :Returns:
+      - names of stages that ran (or would run). Stages with missing inputs are skipped and not returned.
+
+    :Returns Type:
+      list
+    """
+    state = load_state(statePath)
+    ran = []
+    skipped = []
+    # Outputs of stages that would run in dry run, their dependents would run too
+    stale = set()
+    start = time.perf_counter()
+    for name, command, inputs, outputs in stages:
+        if only and name not in only:
+            continue
+        stageStart = time.perf_counter()
+        stageFingerprint, missing = fingerprint(command, inputs, state, root)
+        if name not in force and not stale.intersection(inputs) and is_current(name, stageFingerprint, outputs, state):
+            print(name + ": current (checked in " + str(round(time.perf_counter() - stageStart, 2)) + " s)")
+            continue
+        if missing:
+            print(name + ": skipped, missing inputs " + ', '.join(missing))
+            skipped.append(name)
+            continue
+        ran.append(name)
+        if dryRun:
+            print(name + ": would run")
+            stale.update(outputs)
+            continue
+        print(name + ": running " + ' '.join(command))
+        subprocess.run([sys.executable] + list(command), cwd=root, check=True)
+        state['stages'][name] = {'fingerprint': stageFingerprint,
+                                 'outputs': {path: file_hash(path, state) for path in outputs}}
+        save_state(state, statePath)
+        print(name + ": done in " + str(round(time.perf_counter() - stageStart, 1)) + " s")
+    if not dryRun:
+        save_state(state, statePath)
+    print("Pipeline: " + str(len(ran)) + " of " + str(len(stages)) + " stages " + ("would run" if dryRun else "ran")
+          + ", " + str(len(skipped)) + " skipped in " + str(round(time.perf_counter() - start, 1)) + " s")
+    return ran
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild stages of the pipeline whose inputs, code or outputs changed")
+    parser.add_argument('--dry-run', action='store_true', help="only show which stages would run")
+    parser.add_argument('--force', nargs='*', default=[], help="run these stages even if they are current")
+    parser.add_argument('--only', nargs='*', default=None, help="consider only these stages")
+    args = parser.parse_args()
+    run(only=args.only, force=set(args.force), dryRun=args.dry_run)
@@ -7,10 +7,18 @@ import shapely
 from shapely import speedups
 import matplotlib.pyplot as plt
 import re
+import os
+import csv
+import numpy as np
+import pyogrio
+import resource
+import functools
+from storage import save_stage, report_storage
+from timing import timer, report_timings
+from housenumbers import is_hyphen_number
 speedups.enable()
 
-def expandSuffix(text):
-    suffixDb = {
+suffixDb = {
     "Av": "Avenue",
     "Ave": "Avenue",
     "Avenu": "Avenue",
@@ -170,7 +178,14 @@ def expandSuffix(text):
     "(Rear)": "",
     "Rear)": "",
     "Rea": ""
-    }
+}
+
+
+def expandSuffixReference(text):
+    """
+    Original implementation of expandSuffix() that rewrites the whole string once per suffixDb entry.
+    Kept for benchmarking and checking (see benchmarkExpandSuffix).
+    """
     for k, v in suffixDb.items():
         if text == None:
             break
@@ -180,8 +195,75 @@ def expandSuffix(text):
         text = ' '.join(v if word == k else word for word in text.title().split())
     return(text)
 
+
+def expandWordReference(word):
+    """
+    Runs a single word through all passes of expandSuffixReference() and returns the resulting words.
+    Replacements can be empty or contain several words and are themselves subject to later entries.
+    """
+    words = [word]
+    for k, v in suffixDb.items():
+        words = [v if w == k else w for w in ' '.join(words).title().split()]
+    return(words)
+
+
+# Final replacement of every suffixDb key. Words that are not keys are only title-cased.
+# Empty replacements (Rea) are dropped, so they leave no extra space in the street name.
+suffixExpansion = {k: [word for word in expandWordReference(k) if word] for k in suffixDb}
+
+
+@functools.lru_cache(maxsize=None)
+def expandSuffix(text):
+    """
+    Expands street suffixes and abbreviations (Rd -> Road, N -> North, ...) and title-cases the street name.
+    Each word is expanded with one dictionary lookup and results are cached for repeated street names.
+    Output is identical to expandSuffixReference() with repeated and trailing spaces removed
+    (e.g. 'ELM ST REA' --> 'Elm St', as when the original script expanded a street name twice).
+    """
+    if text == None:
+        return(text)
+    if text == "DR MARTIN LUTHER KING JR":
+        return(text.title())
+    words = []
+    for word in text.title().split():
+        words.extend(suffixExpansion.get(word, (word,)))
+    return(' '.join(words))
+
+
+def benchmarkExpandSuffix(texts, repeat = 1):
+    """
+    Compares run time of expandSuffix() and expandSuffixReference() on a list of street names
+    and checks that results are identical (spaces of reference are normalized).
+    """
+    timings = {}
+    with timer(timings, 'reference'):
+        for _ in range(repeat):
+            reference = [expandSuffixReference(text) for text in texts]
+    expandSuffix.cache_clear()
+    with timer(timings, 'hash lookup'):
+        for _ in range(repeat):
+            result = [expandSuffix(text) for text in texts]
+    report_timings(timings, "expandSuffix on " + str(len(texts) * repeat) + " street names")
+    print("  speedup: " + str(round(timings['reference'] / timings['hash lookup'], 1)) + "x, differences: " + str(sum((a if a is None else ' '.join(a.split())) != b for a, b in zip(reference, result))))
+    return timings
+
+# Irregular LOCATION values that can't be parsed: text -> [house number, unit, street, city]
+def loadLocationExceptions(path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'location_exceptions.csv')):
+    with open(path, newline='') as f:
+        return({row['text']: tuple(row[k] or None for k in ('housenumber', 'unit', 'street', 'city')) for row in csv.DictReader(f)})
+
+locationExceptions = loadLocationExceptions()
+wordPattern = re.compile(r'\S+')
+numberPattern = re.compile(r'(\d+)')
+
+
 # Parse LOCATION tag
 def parseLocation(text):
+    return(list(parseLocationCached(text)))
+
+
+@functools.lru_cache(maxsize=None)
+def parseLocationCached(text):
     out = [None] * 4
     #[0] : House number
     #[1] : Unit
@@ -189,91 +271,10 @@ def parseLocation(text):
     #[3] : City
     # Catch irregular exceptions
     if text == None:
-        return(out)
-    if text == "LANTERN HL (FKA 137)":
-        out[0] = "665"
-        out[2] = "Lantern Hill"
-        return(out)
-    elif text == "LANTERN HL (FKA 133)":
-        out[0] = "663"
-        out[2] = "Lantern Hill"
-        return(out)
-    elif text == "LANTERN HL (FKA 131)":
-        out[0] = "659"
-        out[2] = "Lantern Hill"
-        return(out) 
-    elif text == "LANTERN HL (FKA 130)":
-        out[0] = "658"
-        out[2] = "Lantern Hill"
-        return(out)
-    elif text == "LANTERN HL (FKA 129)":
-        out[0] = "657"
-        out[2] = "Lantern Hill"
-        return(out)
-    elif text == "LANTERN HL (FKA 125)":
-        out[0] = "663"
-        out[2] = "Lantern Hill"
-        return(out)
-    elif text == "LANTERN HL (FKA 123)":
-        out[0] = "651"
-        out[2] = "Lantern Hill"
-        return(out)
-    elif text == "LANTERN HL (FKA 121)":
-        out[0] = "649"
-        out[2] = "Lantern Hill"
-        return(out)
-    elif text == "LANTERN HL (FKA 119)":
-        out[0] = "647"
-        out[2] = "Lantern Hill"
-        return(out)
-    elif text == "LANTERN HL (FKA 133A)":
-        out[0] = "661"
-        out[2] = "Lantern Hill"
-        return(out)
-    elif text == "LANTERN HL (FKA 11 R M)":
-        out[0] = "586A"
-        out[2] = "Lantern Hill"
-        return(out)
-    elif text == "9 - 11  A-D High St":
-        out[0] = "9-11"
-        out[2] = "A-D High Street"
-        return(out)
-    elif text == "Farm View Dr (Norwich)":
-        out[2] = "Farm View Drive"
-        out[3] = "Norwich"
-        return(out)
-    elif text == "Rte 66 S (Lot 6)":
-        out[0] = "6"
-        out[2] = "Route 66 South"
-        return(out)
-    elif text == "Rte 66 S (Lot 1)":
-        out[0] = "1"
-        out[2] = "Route 66 South"
-        return(out)
-    elif text == "Rt 66 S (Lot 2)":
-        out[0] = "2"
-        out[2] = "Route 66 South"
-        return(out)
-    elif text == "Rt 66 S (Lot 3)":
-        out[0] = "3"
-        out[2] = "Route 66 South"
-        return(out)
-    elif text == "Rt 87 W (Lot 3)":
-        out[0] = "3"
-        out[2] = "Route 87 West"
-        return(out)
-    elif text == "DEPOT ST (REAR)":
-        out[2] = "Depot Street"
-        return(out)
-    elif text == "SOUTH C ST 1/2-4 1/2":
-        out[0] = "1/2-4 1/2"
-        out[2] = "South C Street"
-        return(out)
-    elif text == "SOUTH C ST 1/2-8 1/2":
-        out[0] = "1/2-8 1/2"
-        out[2] = "South C Street"
-        return(out)   
-    x = text.title().split()
+        return(tuple(out))
+    if text in locationExceptions:
+        return(locationExceptions[text])
+    x = wordPattern.findall(text.title())
     # House number
     ## For numbers 000023 --> 23
     if x[0].isnumeric():
@@ -281,12 +282,12 @@ def parseLocation(text):
         x.pop(0)
     ## For hyphen numbers 1-24
     elif (x[0].find('-') != -1):
-        if any(map(str.isdigit, x[0])): ## To exclude A-G Hill Street cases
+        if is_hyphen_number(x[0]): ## To exclude A-G Hill Street cases
             out[0] = x[0]
             x.pop(0)
     ## For number-letter conbinations 0002A --> 2A
     elif any(map(str.isdigit, x[0])):
-        y = re.split(r'(\d+)', x[0])
+        y = numberPattern.split(x[0])
         y[1] = str(int(y[1]))
         out[0] = ''.join(y)
         x.pop(0)
@@ -324,145 +325,378 @@ def parseLocation(text):
                 out[0] = x[-1]
             x.pop(-1)
     out[2] = ' '.join(x)     
-    return(out)
-
-
-
-# Read data    
-address = gpd.read_file("/Buildigns_footprints_testing/Address/Connecticut_Buildings_with_Addresses_experimental.shp")
-address.crs = "EPSG:4326"
-
-
-# Calculate area of buildings
-address['area'] = address.geometry.area
-
-# Calculate centroid of the building and set it as address associated geometry
-address['geometry'] = address.geometry.centroid
-
-
-# Remove westCOG towns
+    return(tuple(out))
+
+
+def parseLocationColumn(texts):
+    """
+    Parses a whole column of LOCATION-like strings. Every distinct string is parsed only once.
+
+    :Returns:
+      array with columns [House number, Unit, Street, City]
+
+    :Returns Type:
+      numpy array
+    """
+    codes, uniques = pd.factorize(pd.Series(texts, dtype=object), use_na_sentinel=True)
+    parsed = np.array([parseLocationCached(text) for text in uniques] + [(None,) * 4], dtype=object).reshape(-1, 4)
+    return(parsed[codes])
+
+
+
+## Resolution of OSM address tags from source fields
+# Source street name parts in order of StreetName field
+STREET_NAME_PARTS = ['StreetName', 'StreetNa_1', 'StreetNa_2', 'StreetNa_3', 'StreetNa_4', 'StreetNa_5', 'StreetNa_6']
+# Free text fields parsed by parseLocation(), in order of priority
+LOCATION_SOURCES = ['LocationDe', 'LOCATION', 'Comments']
+LOCATION_FIELDS = ['number', 'unit', 'street', 'city']
+
+
+def expandColumn(column):
+    """
+    Applies expandSuffix() to every value of a column.
+    """
+    return(pd.Series([expandSuffix(item) for item in column], index=column.index, dtype=object))
+
+
+def joinStreetName(address, columns, exclude):
+    """
+    Vectorized equivalent of ' '.join() over street name parts of every row. Missing parts and
+    parts in exclude are skipped. Rows where all parts are missing stay missing, rows where all present
+    parts are excluded get empty string.
+
+    :Parameters:
+      - `address: address GeoDataFrame
+      - `columns: street name part columns in order of joining
+      - `exclude: set of values that are skipped (e.g. 'Rear')
+
+    :Returns:
+      title-cased and suffix expanded street names
+
+    :Returns Type:
+      Series
+    """
+    joined = np.full(len(address), None, dtype=object)
+    present = np.zeros(len(address), dtype=bool)
+    for column in columns:
+        part = address[column].to_numpy(dtype=object)
+        valid = address[column].notnull().to_numpy()
+        present |= valid
+        valid &= ~address[column].isin(exclude).to_numpy()
+        first = valid & (joined == None)
+        both = valid & ~first
+        joined[first] = part[first]
+        joined[both] = joined[both] + ' ' + part[both]
+    joined[(joined == None) & present] = ''
+    return(pd.Series([expandSuffix(item.title()) if item is not None else None for item in joined], index=address.index, dtype=object))
+
+
+def houseNumberColumn(column):
+    """
+    Converts numeric house numbers to int. Missing and zero numbers are missing.
+    """
+    valid = column.notnull() & (column != 0)
+    result = pd.Series(None, index=column.index, dtype=object)
+    result[valid] = column[valid].astype(int).astype(object)
+    return(result)
+
+
+def subaddress(address, typeColumn, types, valueColumn):
+    """
+    Returns values of subaddress valueColumn for rows where typeColumn is one of types.
+    """
+    return(address[valueColumn].where(address[typeColumn].isin(types), None))
+
+
+# Coalesce cascade: sources of OSM address tags in order of priority. Tag gets value of the first rule that provides one.
+# Each rule is (tag, rule name, values, when):
+#   values(address, locations) returns candidate values of the tag for all rows (missing = rule has no value)
+#   when(current) selects rows that the rule assigns. None means rows where the tag is still missing.
+ADDRESS_RULES = [
+    ('addr:street', 'CompleteSt', lambda a, l: expandColumn(a['CompleteSt']), None),
+    ('addr:street', 'StreetName parts', lambda a, l: joinStreetName(a, STREET_NAME_PARTS, {'OM', 'M', 'LP', 'Rear', 'GAR', 'REAR'}), None),
+    ('addr:street', 'StreetName parts after OM/M/LP', lambda a, l: joinStreetName(a, STREET_NAME_PARTS[1:] + STREET_NAME_PARTS[:1], {'Rear', 'GAR', 'REAR'}).where(a['StreetName'].isin({'OM', 'M', 'LP'}), None), None),
+    ('addr:street', 'LocationDe', lambda a, l: l['LocationDe']['street'], None),
+    ('addr:street', 'LOCATION', lambda a, l: l['LOCATION']['street'], None),
+    ('addr:street', 'LOCATION instead of Road', lambda a, l: l['LOCATION']['street'], lambda current: current == 'Road'),
+    ('addr:street', 'Comments', lambda a, l: l['Comments']['street'], None),
+
+    ('addr:housenumber', 'CompleteAd', lambda a, l: a['CompleteAd'], None),
+    ('addr:housenumber', 'AddressN_1', lambda a, l: houseNumberColumn(a['AddressN_1']), None),
+    ('addr:housenumber', 'LocationDe', lambda a, l: l['LocationDe']['number'], None),
+    ('addr:housenumber', 'LOCATION', lambda a, l: l['LOCATION']['number'], None),
+    ('addr:housenumber', 'Comments', lambda a, l: l['Comments']['number'], None),
+
+    ('addr:postcode', 'ZipCode', lambda a, l: a['ZipCode'], None),
+    ('addr:zip4', 'ZipPlus4', lambda a, l: a['ZipPlus4'], None),
+
+    ('addr:city', 'Municipal_', lambda a, l: a['Municipal_'].str.title(), None),
+    ('addr:city', 'TOWN', lambda a, l: a['TOWN'], None),
+
+    ('addr:unit', 'LocationDe', lambda a, l: l['LocationDe']['unit'], None),
+    ('addr:unit', 'LOCATION', lambda a, l: l['LOCATION']['unit'], None),
+    ('addr:unit', 'Comments', lambda a, l: l['Comments']['unit'], None),
+    ('addr:unit', 'Subaddre_1 Unit', lambda a, l: subaddress(a, 'Subaddress', ['Unit'], 'Subaddre_1'), None),
+    ('addr:unit', 'Subaddre_4 Unit', lambda a, l: subaddress(a, 'Subaddre_3', ['Unit'], 'Subaddre_4'), None),
+    ('addr:unit', 'Subaddre_7 UNIT', lambda a, l: subaddress(a, 'Subaddre_6', ['UNIT'], 'Subaddre_7'), None),
+
+    ('addr:flats', 'Subaddre_1 Apartment', lambda a, l: subaddress(a, 'Subaddress', ['Apartment'], 'Subaddre_1'), None),
+    ('addr:flats', 'Subaddre_7 SUITE', lambda a, l: subaddress(a, 'Subaddre_6', ['SUITE'], 'Subaddre_7'), None),
+    ('addr:flats', 'Subaddre_7 APT', lambda a, l: subaddress(a, 'Subaddre_6', ['APT'], 'Subaddre_7'), None),
+
+    ('addr:building', 'Subaddre_1 Building', lambda a, l: subaddress(a, 'Subaddress', ['Building'], 'Subaddre_1'), None),
+
+    ('addr:floor', 'Subaddre_1 Floor', lambda a, l: subaddress(a, 'Subaddress', ['Floor'], 'Subaddre_1'), None),
+    ('addr:floor', 'Subaddre_4 FLOOR', lambda a, l: subaddress(a, 'Subaddre_3', ['FLOOR', 'Floor', 'FLR'], 'Subaddre_4'), None),
+]
+
+
+def parseLocationSources(address, timings = None):
+    """
+    Parses every free text location field once and expands suffixes of parsed street names.
+
+    :Returns:
+      dictionary {source column: DataFrame with columns LOCATION_FIELDS}
+
+    :Returns Type:
+      dict
+    """
+    locations = {}
+    for column in LOCATION_SOURCES:
+        with timer(timings, 'parse ' + column):
+            parsed = pd.DataFrame(parseLocationColumn(address[column]), index=address.index, columns=LOCATION_FIELDS)
+            parsed['street'] = expandColumn(parsed['street'])
+        locations[column] = parsed
+    return(locations)
+
+
+def resolveAddressTags(address, rules = ADDRESS_RULES, fills = None, timings = None):
+    """
+    Evaluates coalesce cascade of rules (see ADDRESS_RULES) in one pass over the rules.
+    Each tag keeps the value of the first rule that provides one (combine_first), unless rule
+    has its own when() selection.
+
+    :Parameters:
+      - `address: address GeoDataFrame with source fields
+      - `rules: list of (tag, rule name, values, when)
+      - `fills: dictionary collecting number of values filled by each rule {(tag, rule name): count}. If None, nothing is recorded.
+      - `timings: dictionary collecting time of each rule in seconds. If None, nothing is recorded.
+
+    :Returns:
+      resolved tags, columns in order of first rule of each tag
+
+    :Returns Type:
+      DataFrame
+    """
+    locations = parseLocationSources(address, timings)
+    tags = {}
+    for tag, name, values, when in rules:
+        with timer(timings, tag + ' <- ' + name):
+            values = values(address, locations)
+            if tag not in tags:
+                selected = pd.Series(True, index=address.index)
+                tags[tag] = values
+            else:
+                current = tags[tag]
+                selected = current.isnull() if when is None else when(current)
+                tags[tag] = current.mask(selected, values)
+        if fills is not None:
+            fills[(tag, name)] = fills.get((tag, name), 0) + int((selected & values.notnull()).sum())
+    return(pd.DataFrame(tags, index=address.index))
+
+
+def reportFills(fills, title = "Address tag sources"):
+    """
+    Prints number of values filled by each rule of the cascade.
+    """
+    print(title)
+    for (tag, name), count in fills.items():
+        print("  " + tag.ljust(18) + name.ljust(34) + str(count).rjust(10))
+
+
+
+# Address tags that together identify a unique address
+ADDRESS_KEYS = ['addr:street', 'addr:housenumber', 'addr:postcode', 'addr:city', 'addr:unit', 'addr:building', 'addr:zip4', 'addr:flats', 'addr:floor']
+
+
+def deduplicateAddresses(address):
+    """
+    Deduplicates addresses by assigning unique address to the largest building.
+    Adresses are duplicated: All buildings on one parcel are tagged with the same address.
+    For addresses with housenumber only the buildings with the largest area (most probably the main house 
+    on the parcel) are kept. If more buildings have the same largest area all of them are kept.
+    Addresses without housenumber are kept as they are. Missing values are valid group keys.
+
+    :Returns:
+      - address_dedup: deduplicated addresses without 'area' column
+
+    :Returns Type:
+      GeoDataFrame
+    """
+    hasNumber = address['addr:housenumber'].notnull()
+    address_remain = address.loc[~hasNumber]
+    address_number = address.loc[hasNumber]
+    maxArea = address_number.groupby(ADDRESS_KEYS, dropna = False, sort = False)['area'].transform('max')
+    address_number = address_number.loc[address_number['area'] == maxArea]
+    # Combine deduplicated addresses with those that don't have house number
+    address_dedup = pd.concat([address_remain, address_number], ignore_index=True).pipe(gpd.GeoDataFrame)
+    address_dedup = address_dedup.drop(columns=['area'])
+    return(address_dedup)
+
+
+def deduplicateAddressesReference(address):
+    """
+    Original implementation of deduplicateAddresses() with groupby().apply() and "none" placeholders.
+    Kept for benchmarking (see benchmarkDeduplication).
+    """
+    # First convert None to "none" otherwise groupby throws an error (groupby converts None to 'nan', which it can't later find in the grouping index)
+    address_dedup = address.fillna("none")
+    # Deduplicate addresses with houssenumber
+    address_dedup = address_dedup.loc[ address['addr:housenumber'].notnull() ].groupby(ADDRESS_KEYS, dropna = False).apply(func = lambda x: x.loc[ x['area'] == x['area'].max() ])
+    address_remain = address.loc[address['addr:housenumber'].isnull()]
+    # Convert "none" back to None
+    address_dedup = address_dedup.replace(to_replace={'none': None}, value=None)
+    # Combine deduplicated addresses with those that don't have house number
+    address_dedup = pd.concat([address_remain, address_dedup]).pipe(gpd.GeoDataFrame)
+    address_dedup = address_dedup.reset_index()
+    address_dedup = address_dedup.drop(columns=['index', 'area'])
+    return(address_dedup)
+
+
+def benchmarkDeduplication(address):
+    """
+    Compares run time of deduplicateAddresses() and deduplicateAddressesReference()
+    and checks that both keep the same buildings.
+    """
+    timings = {}
+    with timer(timings, 'groupby apply'):
+        reference = deduplicateAddressesReference(address)
+    with timer(timings, 'groupby transform'):
+        result = deduplicateAddresses(address)
+    report_timings(timings, "Deduplication of " + str(len(address)) + " addresses")
+    print("  speedup: " + str(round(timings['groupby apply'] / timings['groupby transform'], 1)) + "x")
+    print("  kept: " + str(len(reference)) + " vs " + str(len(result)) + ", same buildings: " + str(sorted(shapely.to_wkb(reference.geometry.values)) == sorted(shapely.to_wkb(result.geometry.values))))
+    return timings
+
+
+SOURCE = "/Buildigns_footprints_testing/Address/Connecticut_Buildings_with_Addresses_experimental.shp"
+BATCH_SIZE = 100000
+
+# WestCOG towns
 # Note: Weston, Ridgefield, New Fairfield are not part of dataset
-address = address.loc[ ~address['TOWN_NO'].isin([9, 16, 18, 34, 35, 57, 90, 96, 97, 103, 117, 127, 135, 158, 161]) ]
-address = address.reset_index()
+WESTCOG_TOWNS = [9, 16, 18, 34, 35, 57, 90, 96, 97, 103, 117, 127, 135, 158, 161]
 
-# Remove extra columns
-address = address.drop(columns=['OBJECTID', 'FID_Parcel', 'Join_Count', 'TARGET_FID', 'TOWN_NO', 'MBL', 'PIN', 'ACRES', 'SeparatorE', 'StreetNa_7', 'Subaddre_2',
+# Extra columns that are not read at all
+DROP_COLUMNS = ['OBJECTID', 'FID_Parcel', 'Join_Count', 'TARGET_FID', 'TOWN_NO', 'MBL', 'PIN', 'ACRES', 'SeparatorE', 'StreetNa_7', 'Subaddre_2',
   'Subaddre_5', 'Subaddre_8', 'Subaddre_9', 'Subaddre10', 'Subaddre11', 'Subaddre12', 'Subaddre13', 'Subaddre14', 'Subaddre15', 'Subaddre16', 
   'Subaddre17', 'StateName', 'ESN', 'AddressID', 'RelatedAdd', 'AddressRel', 'AddressPar', 'AddressP_1', 'AddressXCo', 'AddressYCo', 'AddressEle',
   'AddressCla', 'AddressLif', 'OfficialSt', 'AddressAno', 'AddressSta', 'AddressEnd', 'AddressDir', 'NeedsRevie', 'Point_ID', 'FID_Buildi', 'CircleBuil',
-  'ShapeSTLen', 'ShapeSTAre', 'index', 'Community_', 'USPS_Place', 'County_Pla', 'AddressAut', 'E911_Place', 'AddressLon', 'AddressLat', 'AddressFea',
-  'LandmarkNa'])
-
-
-# Convert address values
-address.loc[:,'addr:street'] = [expandSuffix(item) for item in address.loc[:,'CompleteSt']]
-address.loc[:,'addr:housenumber'] = address.loc[:,'CompleteAd']
-address.loc[:,'addr:postcode'] = address.loc[:,'ZipCode']
-address.loc[:,'addr:zip4'] = address.loc[:,'ZipPlus4']
-
-address.loc[address['Municipal_'].notnull(), 'addr:city'] = address.loc[address['Municipal_'].notnull(), 'Municipal_'].apply(lambda x: x.title())
-address.loc[address['Municipal_'].isnull(), 'addr:city'] = address.loc[address['Municipal_'].isnull(), 'TOWN']
-
-# If CompleteAd is empty then use AddressN_1, StreetNa_3, StreetNa_4
-address.loc[address['addr:housenumber'].isnull() & address['AddressN_1'].notnull() & (address['AddressN_1'] != 0.0), 'addr:housenumber'] = address.loc[address['addr:housenumber'].isnull() & address['AddressN_1'].notnull() & (address['AddressN_1'] != 0.0), 'AddressN_1'].apply(lambda x: int(x))
-address.loc[address['addr:street'].isnull(), 'addr:street'] = address.loc[address['addr:street'].isnull(), ['StreetName', 'StreetNa_1', 'StreetNa_2', 'StreetNa_3', 'StreetNa_4', 'StreetNa_5', 'StreetNa_6']].apply(lambda x: ' '.join(filter(lambda y: y not in {None, 'OM', 'M', 'LP', 'Rear', 'GAR', 'REAR'}, x)).title() if x.notnull().any() else None, axis = 1)
-address.loc[address['addr:street'].isnull() & address['StreetName'].isin({'OM', 'M', 'LP'}), 'addr:street'] = address.loc[address['addr:street'].isnull() & address['StreetName'].isin({'OM', 'M', 'LP'}), ['StreetNa_1', 'StreetNa_2', 'StreetNa_3', 'StreetNa_4', 'StreetNa_5', 'StreetNa_6', 'StreetName']].apply(lambda x: ' '.join(filter(lambda y: y not in {None, 'Rear', 'GAR', 'REAR'}, x)).title() if x.notnull().any() else None, axis = 1)
-
-address.loc[:,'addr:street'] = [expandSuffix(item) for item in address.loc[:,'addr:street']]
-
-# Parse and use LocationDescription
-address.loc[:,['temp_number', 'temp_unit', 'temp_street', 'temp_city']] = [parseLocation(item) for item in address.loc[:,'LocationDe']]
-address.loc[:,'temp_street'] = [expandSuffix(item) for item in address.loc[:,'temp_street']]
-address.loc[address['addr:housenumber'].isnull(), 'addr:housenumber'] = address.loc[address['addr:housenumber'].isnull(), 'temp_number']
-address.loc[address['addr:street'].isnull(), 'addr:street'] = address.loc[address['addr:street'].isnull(), 'temp_street']
-address.loc[:,'addr:unit'] = address.loc[:, 'temp_unit']
-
-# Parse and use LOCATION 
-address.loc[:,['temp_number', 'temp_unit', 'temp_street', 'temp_city']] = [parseLocation(item) for item in address.loc[:,'LOCATION']]
-address.loc[:,'temp_street'] = [expandSuffix(item) for item in address.loc[:,'temp_street']]
-address.loc[address['addr:street'].isnull(), 'addr:street'] = address.loc[address['addr:street'].isnull(), 'temp_street'] 
-address.loc[address['addr:housenumber'].isnull(), 'addr:housenumber'] = address.loc[address['addr:housenumber'].isnull(), 'temp_number'] 
-address.loc[address['addr:street'] == 'Road', 'addr:street'] = address.loc[address['addr:street'] == 'Road', 'temp_street']
-address.loc[address['addr:unit'].isnull(), 'addr:unit'] = address.loc[address['addr:unit'].isnull(), 'temp_unit'] 
-
-
-# Parse and use Comments
-address.loc[:,['temp_number', 'temp_unit', 'temp_street', 'temp_city']] = [parseLocation(item) for item in address.loc[:,'Comments']]
-address.loc[:,'temp_street'] = [expandSuffix(item) for item in address.loc[:,'temp_street']]
-address.loc[address['addr:street'].isnull(), 'addr:street'] = address.loc[address['addr:street'].isnull(), 'temp_street']
-address.loc[address['addr:housenumber'].isnull(), 'addr:housenumber'] = address.loc[address['addr:housenumber'].isnull(), 'temp_number']
-address.loc[address['addr:unit'].isnull(), 'addr:unit'] = address.loc[address['addr:unit'].isnull(), 'temp_unit'] 
-
-
-# Units
-address.loc[(address['Subaddress'] == 'Unit') & address['Subaddre_1'].notnull() & address['addr:unit'].isnull(), 'addr:unit'] = address.loc[(address['Subaddress'] == 'Unit') & address['Subaddre_1'].notnull() & address['addr:unit'].isnull(), 'Subaddre_1']
-address.loc[(address['Subaddress'] == 'Apartment') & address['Subaddre_1'].notnull(), 'addr:flats'] = address.loc[(address['Subaddress'] == 'Apartment') & address['Subaddre_1'].notnull(), 'Subaddre_1']
-address.loc[(address['Subaddress'] == 'Building') & address['Subaddre_1'].notnull(), 'addr:building'] = address.loc[(address['Subaddress'] == 'Building') & address['Subaddre_1'].notnull(), 'Subaddre_1']
-address.loc[address['Subaddress'] == 'Floor', 'addr:floor'] = address.loc[address['Subaddress'] == 'Floor', 'Subaddre_1']
-
-address.loc[(address['Subaddre_3'] == 'Unit') & address['addr:unit'].isnull(), 'addr:unit'] = address.loc[(address['Subaddre_3'] == 'Unit') & address['addr:unit'].isnull(), 'Subaddre_4']
-address.loc[address['Subaddre_3'].isin(['FLOOR', 'Floor', 'FLR', 'LEVEL']) & address['addr:floor'].isnull(), 'addr:floor'] = address.loc[address['Subaddre_3'].isin(['FLOOR', 'Floor', 'FLR']) & address['addr:floor'].isnull(), 'Subaddre_4']
-
-
-address.loc[(address['Subaddre_6'] == 'SUITE') & address['addr:flats'].isnull(), 'addr:flats'] = address.loc[(address['Subaddre_6'] == 'SUITE') & address['addr:flats'].isnull(), 'Subaddre_7']
-address.loc[(address['Subaddre_6'] == 'UNIT') & address['addr:unit'].isnull(), 'addr:unit'] = address.loc[(address['Subaddre_6'] == 'UNIT') & address['addr:unit'].isnull(), 'Subaddre_7']
-address.loc[(address['Subaddre_6'] == 'APT') & address['addr:flats'].isnull(), 'addr:flats'] = address.loc[(address['Subaddre_6'] == 'APT') & address['addr:flats'].isnull(), 'Subaddre_7']
-
-
-# Fixes
-address.loc[address['addr:housenumber'].isin(['Vac-Unbld', 'Vac-Poten','2-Family', '1-Family', 'Mdl-96', '3-Family', '4-Family', 'Land-Undevl', '0', 'In-Law']), 'addr:housenumber'] = None
-
-address.loc[address['addr:floor'].isin(['2FL', '2nd', '2ND']), 'addr:floor'] = "2"
-address.loc[address['addr:floor'] == '1ST', 'addr:floor'] = "1"
-address.loc[address['addr:floor'] == 'BSMT', 'addr:floor'] = "basement"
-
-address.loc[address['addr:flats'].isin(['2ND FLR', '2ND FL', '2FL']), ['addr:flats','addr:floor']] = [None, "2"]
-address.loc[address['addr:flats'] == '3FL#5', ['addr:flats','addr:floor']] = ["5", "3"]
-address.loc[address['addr:flats'] == '1 2FL', ['addr:flats','addr:floor']] = ["1", "2"]
-address.loc[address['addr:flats'] == '#3', 'addr:flats'] = "3"
-address.loc[address['addr:flats'] == '3FL', ['addr:flats','addr:floor']] = [None, "3"]
-address.loc[address['addr:flats'] == '1FL', ['addr:flats','addr:floor']] = [None, "1"]
-
-
-address.loc[address['addr:unit'].isin(['Rd-Church', 'Rd-Firehouse', 'Lane-Rear', '4/5/2013.', '0']), 'addr:unit'] = None
-address.loc[address['addr:unit'].notnull(), 'addr:unit'] = address.loc[address['addr:unit'].notnull(), 'addr:unit'].apply(lambda x: re.sub('[)(#)]', '', x))
-address.loc[address['addr:unit'].notnull(), 'addr:unit'] = address.loc[address['addr:unit'].notnull(), 'addr:unit'].apply(lambda x: re.sub('Road', '', x))
-
-
-
-# Remove no address buildings (those without housenumber and street name)
-address = address.loc[address['addr:housenumber'].notnull() | address['addr:street'].notnull(), ]
-address = address.reset_index()
-
-
-# Remove unwanted columns
-address = address.drop(columns=['TOWN', 'LOCATION', 'AddressNum', 'AddressN_1', 'AddressN_2',
-       'StreetName', 'StreetNa_1', 'StreetNa_2', 'StreetNa_3', 'StreetNa_4',
-       'StreetNa_5', 'StreetNa_6', 'Subaddress', 'Subaddre_1', 'Subaddre_3',
-       'Subaddre_4', 'Subaddre_6', 'Subaddre_7', 'Municipal_', 'ZipCode',
-       'ZipPlus4', 'LocationDe', 'Comments', 'CompleteAd', 'CompleteSt',
-       'Source_Joi', 'Source_J_1', 'Source_J_2', 'temp_number', 'temp_unit', 
-       'temp_street', 'temp_city', 'index'])
-
-
-# Export unduplicated
-address.to_file('/Buildigns_footprints_testing/Address/CTAddressAll-parsed.geojson', driver='GeoJSON')
-
-
-## Deduplicate addresses by assigning unique address to the larges building
-# Adresses are duplicated: All buildings on one parcel are tagged with the same address
-# For buildings witch address countains housenumber remove duplicates by keeping only that building that has the largest area (most probably the main house on the parcel)
-# First convert None to "none" otherwise groupby throws an error (groupby converts None to 'nan', which it can't later find in the grouping index)
-address_dedup = address.fillna("none")
-# Deduplicate addresses with houssenumber
-address_dedup = address_dedup.loc[ address['addr:housenumber'].notnull() ].groupby(['addr:street', 'addr:housenumber', 'addr:postcode', 'addr:city', 'addr:unit', 'addr:building', 'addr:zip4', 'addr:flats', 'addr:floor'], dropna = False).apply(func = lambda x: x.loc[ x['area'] == x['area'].max() ])
-address_remain = address.loc[address['addr:housenumber'].isnull()]
-# Convert "none" back to None
-address_dedup = address_dedup.replace(to_replace={'none': None}, value=None, method=None)
-
-# Combine deduplicated addresses with those that don't have house number
-address_dedup = pd.concat([address_remain, address_dedup]).pipe(gpd.GeoDataFrame)
-address_dedup = address_dedup.reset_index()
-address_dedup = address_dedup.drop(columns=['index', 'area'])
-address_dedup.crs = "EPSG:4326"
-address_dedup.to_file('/Buildigns_footprints_testing/Address/CTAddressDedup-parsed.geojson', driver='GeoJSON')
+  'ShapeSTLen', 'ShapeSTAre', 'Community_', 'USPS_Place', 'County_Pla', 'AddressAut', 'E911_Place', 'AddressLon', 'AddressLat', 'AddressFea',
+  'LandmarkNa']
+
+
+def read_batches(source, batchSize = BATCH_SIZE):
+    """
+    Streams source file in record batches. Only columns used by the normalization are read.
+
+    :Returns:
+      Generator of GeoDataFrames in EPSG:4326
+
+    :Returns Type:
+      generator
+    """
+    columns = [c for c in pyogrio.read_info(source)['fields'] if c not in DROP_COLUMNS or c == 'TOWN_NO']
+    with pyogrio.open_arrow(source, columns=columns, batch_size=batchSize, use_pyarrow=True) as (meta, reader):
+        geometryName = meta['geometry_name'] or 'wkb_geometry'
+        for batch in reader:
+            batch = batch.to_pandas()
+            geometry = shapely.from_wkb(batch.pop(geometryName))
+            yield gpd.GeoDataFrame(batch, geometry=geometry, crs="EPSG:4326")
+
+
+def prepare_batch(address):
+    """
+    Replaces building polygons by their centroids, keeps their area and removes WestCOG towns.
+    """
+    # Calculate area of buildings
+    address['area'] = address.geometry.area
+    # Calculate centroid of the building and set it as address associated geometry
+    address['geometry'] = address.geometry.centroid
+    # Remove westCOG towns
+    address = address.loc[ ~address['TOWN_NO'].isin(WESTCOG_TOWNS) ]
+    address = address.drop(columns=['TOWN_NO'])
+    address = address.reset_index(drop=True)
+    return address
+
+
+def normalize_addresses(address, fills = None, timings = None):
+    """
+    Converts source address fields to OSM addr:* tags. Works on any subset of rows (batch).
+    Number of values filled by each rule and rule timings are added to fills and timings (see resolveAddressTags).
+    """
+    # Convert address values
+    tags = resolveAddressTags(address, ADDRESS_RULES, fills, timings)
+    for tag in tags.columns:
+        address[tag] = tags[tag]
+
+
+    # Fixes
+    address.loc[address['addr:housenumber'].isin(['Vac-Unbld', 'Vac-Poten','2-Family', '1-Family', 'Mdl-96', '3-Family', '4-Family', 'Land-Undevl', '0', 'In-Law']), 'addr:housenumber'] = None
+
+    address.loc[address['addr:floor'].isin(['2FL', '2nd', '2ND']), 'addr:floor'] = "2"
+    address.loc[address['addr:floor'] == '1ST', 'addr:floor'] = "1"
+    address.loc[address['addr:floor'] == 'BSMT', 'addr:floor'] = "basement"
+
+    address.loc[address['addr:flats'].isin(['2ND FLR', '2ND FL', '2FL']), ['addr:flats','addr:floor']] = [None, "2"]
+    address.loc[address['addr:flats'] == '3FL#5', ['addr:flats','addr:floor']] = ["5", "3"]
+    address.loc[address['addr:flats'] == '1 2FL', ['addr:flats','addr:floor']] = ["1", "2"]
+    address.loc[address['addr:flats'] == '#3', 'addr:flats'] = "3"
+    address.loc[address['addr:flats'] == '3FL', ['addr:flats','addr:floor']] = [None, "3"]
+    address.loc[address['addr:flats'] == '1FL', ['addr:flats','addr:floor']] = [None, "1"]
+
+
+    address.loc[address['addr:unit'].isin(['Rd-Church', 'Rd-Firehouse', 'Lane-Rear', '4/5/2013.', '0']), 'addr:unit'] = None
+    address.loc[address['addr:unit'].notnull(), 'addr:unit'] = address.loc[address['addr:unit'].notnull(), 'addr:unit'].apply(lambda x: re.sub('[)(#)]', '', x))
+    address.loc[address['addr:unit'].notnull(), 'addr:unit'] = address.loc[address['addr:unit'].notnull(), 'addr:unit'].apply(lambda x: re.sub('Road', '', x))
+
+
+
+    # Remove no address buildings (those without housenumber and street name)
+    address = address.loc[address['addr:housenumber'].notnull() | address['addr:street'].notnull(), ]
+    address = address.reset_index()
+
+
+    # Remove unwanted columns
+    address = address.drop(columns=['TOWN', 'LOCATION', 'AddressNum', 'AddressN_1', 'AddressN_2',
+           'StreetName', 'StreetNa_1', 'StreetNa_2', 'StreetNa_3', 'StreetNa_4',
+           'StreetNa_5', 'StreetNa_6', 'Subaddress', 'Subaddre_1', 'Subaddre_3',
+           'Subaddre_4', 'Subaddre_6', 'Subaddre_7', 'Municipal_', 'ZipCode',
+           'ZipPlus4', 'LocationDe', 'Comments', 'CompleteAd', 'CompleteSt',
+           'Source_Joi', 'Source_J_1', 'Source_J_2', 'index'])
+    return address
+
+
+if __name__ == "__main__":
+    # Read data in batches and normalize each batch, so whole polygon dataset is never in memory
+    batches = []
+    fills = {}
+    timings = {}
+    for batch in read_batches(SOURCE, BATCH_SIZE):
+        batches.append(normalize_addresses(prepare_batch(batch), fills, timings))
+        print("Normalized " + str(sum(len(b) for b in batches)) + " addresses, peak RSS " + str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024) + " MB")
+    address = pd.concat(batches, ignore_index=True).pipe(gpd.GeoDataFrame)
+    address.crs = "EPSG:4326"
+    del batches
+    reportFills(fills)
+    report_timings(timings, "Address tag resolution")
+
+
+    # Export unduplicated
+    save_stage(address, '/Buildigns_footprints_testing/Address/CTAddressAll-parsed')
+
+
+    ## Deduplicate addresses by assigning unique address to the larges building
+    address_dedup = deduplicateAddresses(address)
+    address_dedup.crs = "EPSG:4326"
+    save_stage(address_dedup, '/Buildigns_footprints_testing/Address/CTAddressDedup-parsed')
+    report_storage()
@@ -1,22 +1,14 @@
 #!/bin/bash
 
 
-mkdir ortho
-mkdir raw
+mkdir -p ortho
+mkdir -p raw
 
 
 module load miniconda
 conda activate GIS
 
-jobs=0
-for i in {0..29}; do
-    python orthogonalize.py $i &
-
-    ((jobs++))
-    if (($jobs % 20 == 0)); then
-        wait
-    fi
-done
-wait
+# Uses all CPU cores, chunks are distributed to workers as they become free
+python orthogonalize_parallel.py
 
 conda deactivate
@@ -11,6 +11,9 @@ from shapely import affinity
 import matplotlib.pyplot as plt
 import math
 import statistics
+import numpy as np
+from storage import save_stage
+from outlines import touching_pairs, build_outlines
 speedups.enable()
 
 # Load data
@@ -37,42 +40,35 @@ decks = buildings.loc[buildings['CODE'] == 'Deck', ]
 validBuilds = buildings.loc[buildings.is_valid,]
 #notvalidBuilds = buildings.loc[ ~buildings.is_valid,]
 
-# Find indexes of polygons that touch decks
-touching = []
-for j in range(1, len(decks)):
-    indx = validBuilds[ validBuilds['geometry'].intersects(decks.iloc[j]['geometry']) ].index.tolist()
-    touching.append(indx)
-# Remove empty values 
-touching = list(filter(None, touching))
-# Flatten
-touching = [item for items in touching for item in items]
-# Remove duplicates
-touching = list(set(touching))
+# Find indexes of polygons that touch decks: all decks are queried at once against spatial index of valid buildings
+deckIdx, buildIdx = touching_pairs(validBuilds.geometry.values, decks.geometry.values)
+touching = np.unique(validBuilds.index.values[buildIdx])
 
 # Get decks + touching parts
-decks2 = validBuilds.loc[touching, ]
-# Convert to building parts
-decks2.loc[decks2['building'] == 'yes', 'building:part'] = 'yes'
-decks2 = decks2.drop(columns=['building'])
+decks2 = validBuilds.loc[touching, ].copy()
 # Get buildings that don't have attached Deck
 nonDeckBuildsIndex = list(set(buildings.index) - set(decks2.index))
 nonDeckBuilds = buildings.loc[ nonDeckBuildsIndex, ]
 
 # Combine Deck shapes and touching parts into outlines
-decks_u = gpd.GeoDataFrame(geometry=list(decks2.unary_union))
-# Tag as buildings
+# Each group of touching polygons is merged separately, membership says to which outline each polygon belongs
+outlines, membership = build_outlines(decks2.geometry.values)
+isPart = membership >= 0
+
+# Convert polygons of outlines to building parts
+decks2.loc[isPart & (decks2['building'] == 'yes').values, 'building:part'] = 'yes'
+decks2.loc[isPart, 'building'] = None
+# Decks that are not touching any buildings stay decks
+decks2.loc[~isPart, 'building:part'] = None
+decks2.loc[~isPart & (decks2['CODE'] == 'Deck').values, 'building'] = 'deck'
+
+# Tag outlines as buildings
+decks_u = gpd.GeoDataFrame(geometry=outlines)
 decks_u.loc[:, 'building'] = 'yes'
 
-
 # Merge Deck shapes and touching parts with their outlines
 decks_comb = pd.concat([decks2, decks_u]).pipe(gpd.GeoDataFrame)
 
-# Fix those decks that were not touching any buildings and now they have a duplicate outline
-# Re-tag building:part ->  building
-decks_comb.loc[ decks_comb.duplicated(subset='geometry', keep='last'), ['building:part', 'building'] ] = [ None , 'deck']
-# Remove duplicate outlines
-decks_comb = decks_comb.drop_duplicates(subset='geometry', keep='first')
-
 
 # Recreate the full data set (deck-containing buildings + non-deck builsgins)
 buildings_comb = pd.concat([nonDeckBuilds, decks_comb]).pipe(gpd.GeoDataFrame)
@@ -88,6 +84,6 @@ buildings_comb = buildings_comb.drop(columns=['index', 'CODE'])
 # Set coord system
 buildings_comb.crs = "EPSG:4326"
 
-# Save output to shape file
-buildings_comb.to_file('/Buildigns_footprints_testing/Hartford/Building-shp/Hartford_buildings_parsedSimp1.geojson', driver='GeoJSON')
+# Save output
+save_stage(buildings_comb, '/Buildigns_footprints_testing/Hartford/Building-shp/Hartford_buildings_parsedSimp1')
 
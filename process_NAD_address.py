@@ -0,0 +1,254 @@
+# Processing of NAD (National Address Database) address points
+# Python version of Process_NAD_address.R. CSV is read with pyarrow block by block, so also the national
+# NAD file can be processed in constant memory; only rows of one state are kept.
+# Columns are normalized with Arrow string kernels, street names (few distinct values) with one compiled regex
+# per distinct name. Irregular Unit values are fixed by one lookup in a table (nad_unit_fixes.csv).
+#
+# Usage: python process_NAD_address.py [--source NAD_r6.txt] [--state CT]
+
+import geopandas as gpd
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv
+import shapely
+import csv
+import os
+import re
+import time
+import argparse
+from fill_zip_town import ZIP_AREAS, load_lookup_layers, lookup_points
+
+
+SOURCE = os.path.expanduser("~/Desktop/Buildings/NAD_address/NAD_r6_TXT/TXT/NAD_r6_CT_header.csv")
+OUTPUT = os.path.expanduser("~/Desktop/Buildings/NAD_address/NAD_r6_TXT/TXT/CT-address.geojson")
+
+TEXT_COLUMNS = ['State', 'Unit', 'Building', 'AddNum_Suf', 'AddNum_Pre', 'StN_PosMod', 'StN_PosDir', 'StN_PreDir',
+                'StN_PosTyp', 'StN_PreTyp', 'Zip_Code', 'Post_Comm', 'StreetName']
+# Zip codes are read as text to keep leading zeros
+COLUMN_TYPES = dict({column: pa.string() for column in TEXT_COLUMNS}, Add_Number=pa.int64(), Longitude=pa.float64(), Latitude=pa.float64())
+
+# Parts of street names removed or replaced before expansion of abbreviations
+STREET_NOTES = {"(Rear)": "", "(CITY)": "", "(MYSTIC)": "", "(NOANK)": "", "(GLP)": "", "(WEST SIDE)": "", "(2)": " 2", "(1)": " 1",
+                "(3)": " 3", "(6)": " 6", "(OCCUM)": "", "(SOWIND)": ""}
+STREET_ABBREVIATIONS = {"Ave": "Avenue", "St": "Street", "Dr": "Drive", "Trl": "Trail", "Ln": "Lane", "Pl": "Place", "Lk": "Lake",
+                        "Rd": "Road", "Hl": "Hill", "E": "East", "W": "West", "N": "North", "S": "South", "Tr": "Trail", "Terr": "Terrace",
+                        "Tpke": "Turnpike", "NB": "Northbound", "SB": "Southbound", "Ct": "Court", "Pt": "Point", "Ext": "Extension", "Pk": "Park"}
+streetNotePattern = re.compile('|'.join(re.escape(note) for note in STREET_NOTES))
+streetAbbreviationPattern = re.compile(r'\b(' + '|'.join(STREET_ABBREVIATIONS) + r')\b')
+CITY_PREFIXES = {"E ": "East ", "W ": "West ", "No ": "North ", "So ": "South "}
+# Words for title case: letters and digits, with apostrophes inside (ICU word boundaries)
+titleWordPattern = re.compile(r"[^\W_]+(?:'[^\W_]+)*")
+
+# Prefixes removed from Unit, in order of priority: (Unit contains, removed prefix)
+UNIT_PREFIXES = [('Unit', '^Unit '), ('UNIT', '^UNIT '), ('Apartment', '^Apartment '), ('Suite', '^Suite '), ('Room', '^Room '),
+                 ('#', '^#'), ('-', '^-'), ('^UN', '^UN')]
+# Unit values that describe building, lot or floor instead of unit
+UNIT_NOT_UNIT = 'Lot|Bsmt|Building |Bldg |Condo'
+
+
+# Irregular Unit values: Unit -> addr:unit, addr:floor, addr:building (empty building = keep Building)
+def load_unit_fixes(path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nad_unit_fixes.csv')):
+    with open(path, newline='') as f:
+        fixes = pd.DataFrame(list(csv.DictReader(f))).set_index('Unit')
+    return fixes.replace('', None)
+
+unitFixes = load_unit_fixes()
+
+
+def title_case(text):
+    """
+    Capitalizes the first character of every word and lowercases the rest, as str_to_title in R (ICU).
+    Unlike str.title(), letters after digits and apostrophes stay lowercase: '2ND' --> '2nd', "O'NEIL" --> "O'neil".
+    """
+    return titleWordPattern.sub(lambda m: m.group(0).capitalize(), text)
+
+
+def expand_street_name(name):
+    name = streetNotePattern.sub(lambda m: STREET_NOTES[m.group(0)], name)
+    name = streetAbbreviationPattern.sub(lambda m: STREET_ABBREVIATIONS[m.group(1)], name)
+    return title_case(name)
+
+
+def map_distinct(values, function):
+    """
+    Applies function to every distinct value of a text column only once. Missing values become empty strings.
+
+    :Parameters:
+      - `values: pyarrow string array
+      - `function: function of one string returning string
+
+    :Returns Type:
+      pyarrow array
+    """
+    codes, uniques = pd.factorize(pd.Series(values.to_numpy(zero_copy_only=False), dtype=object), use_na_sentinel=True)
+    mapped = np.array([function(value) for value in uniques] + [''], dtype=object)
+    return pa.array(mapped[codes], type=pa.string())
+
+
+def expand_street_names(names):
+    """
+    Removes notes in parentheses, expands abbreviations (St --> Street) and title-cases street names.
+    Every distinct name is processed only once.
+
+    :Returns Type:
+      pyarrow array
+    """
+    return map_distinct(names, expand_street_name)
+
+
+def join_words(*columns):
+    """
+    Joins text columns with space and removes repeated and trailing spaces (paste + str_squish).
+    """
+    joined = pc.binary_join_element_wise(*columns, ' ', null_handling='replace', null_replacement='')
+    return pc.utf8_trim_whitespace(pc.replace_substring_regex(joined, r'\s+', ' '))
+
+
+def normalize_units(unit, building):
+    """
+    Splits NAD Unit into addr:unit, addr:floor and addr:building (same rules as Process_NAD_address.R):
+    values from nad_unit_fixes.csv are found by one hash lookup, the rest only loses prefixes like 'Unit ' or '#'.
+    Units that name a lot, basement, condo or building are moved to addr:building or dropped.
+
+    :Parameters:
+      - `unit, building: Unit and Building columns (pyarrow arrays)
+
+    :Returns:
+      - addr:unit, addr:floor, addr:building (numpy arrays)
+
+    :Returns Type:
+      tuple
+    """
+    # Rules are evaluated once per distinct Unit, missing Unit is the last one
+    codes, uniques = pd.factorize(pd.Series(unit.to_numpy(zero_copy_only=False), dtype=object), use_na_sentinel=True)
+    units = pd.Series(np.append(uniques.astype(object), None), dtype=object)
+
+    # Only the first matching prefix rule is applied
+    addrUnit = units.to_numpy(copy=True)
+    done = np.zeros(len(units), dtype=bool)
+    for contains, prefix in UNIT_PREFIXES:
+        rule = ~done & units.str.contains(contains, na=False).to_numpy(dtype=bool)
+        addrUnit[rule] = units[rule].str.replace(prefix, '', regex=True).to_numpy()
+        done |= rule
+    notUnit = units.str.contains(UNIT_NOT_UNIT, na=False).to_numpy(dtype=bool)
+    addrUnit[notUnit] = None
+    addrFloor = np.full(len(units), None, dtype=object)
+    # Units that replace Building (setBuilding) and their value
+    lot = units.str.contains('Lot', na=False).to_numpy(dtype=bool)
+    dropBuilding = ~lot & units.str.contains('Building |Bldg ', na=False).to_numpy(dtype=bool)
+    keepUnit = lot | (~dropBuilding & units.str.contains('Condo', na=False).to_numpy(dtype=bool))
+    setBuilding = keepUnit | dropBuilding
+    buildingValue = np.where(keepUnit, units.to_numpy(), None)
+
+    # Irregular values
+    row = unitFixes.index.get_indexer(units)
+    fixed = np.flatnonzero(row >= 0)
+    addrUnit[fixed] = unitFixes['unit'].to_numpy()[row[fixed]]
+    addrFloor[fixed] = unitFixes['floor'].to_numpy()[row[fixed]]
+    fixedBuilding = unitFixes['building'].to_numpy()[row[fixed]]
+    fixed = fixed[pd.notnull(fixedBuilding)]
+    buildingValue[fixed] = fixedBuilding[pd.notnull(fixedBuilding)]
+    setBuilding[fixed] = True
+
+    addrBuilding = np.where(setBuilding[codes], buildingValue[codes], building.to_numpy(zero_copy_only=False).astype(object))
+    return addrUnit[codes], addrFloor[codes], addrBuilding
+
+
+def normalize_batch(batch):
+    """
+    Converts one block of NAD rows to OSM address tags.
+
+    :Parameters:
+      - `batch: pyarrow RecordBatch with NAD columns
+
+    :Returns:
+      - addresses with OSM tags in EPSG:4326
+
+    :Returns Type:
+      GeoDataFrame
+    """
+    housenumber = join_words(batch['AddNum_Pre'], pc.cast(batch['Add_Number'], pa.string()), batch['AddNum_Suf'])
+
+    city = map_distinct(batch['Post_Comm'], title_case)
+    for prefix, replacement in CITY_PREFIXES.items():
+        city = pc.replace_substring(city, prefix, replacement)
+
+    streetName = expand_street_names(batch['StreetName'])
+    hasPreType = pc.not_equal(batch['StN_PreTyp'], '')
+    street = pc.if_else(hasPreType,
+                        join_words(batch['StN_PreTyp'], streetName, batch['StN_PosMod']),
+                        join_words(batch['StN_PreDir'], streetName, batch['StN_PosTyp'], batch['StN_PosDir']))
+
+    unit, floor, building = normalize_units(batch['Unit'], batch['Building'])
+    addresses = pd.DataFrame({
+        'addr:building': building,
+        'addr:postcode': batch['Zip_Code'].to_numpy(zero_copy_only=False),
+        'addr:housenumber': housenumber.to_numpy(zero_copy_only=False),
+        'addr:city': city.to_numpy(zero_copy_only=False),
+        'addr:state': batch['State'].to_numpy(zero_copy_only=False),
+        'addr:street': street.to_numpy(zero_copy_only=False),
+        'addr:unit': unit,
+        'addr:floor': floor}, dtype=object)
+    addresses = addresses.replace('', None)
+    geometry = shapely.points(batch['Longitude'].to_numpy(zero_copy_only=False), batch['Latitude'].to_numpy(zero_copy_only=False))
+    return gpd.GeoDataFrame(addresses, geometry=geometry, crs="EPSG:4326")
+
+
+def read_nad(source, state = None, blockSize = 64 * 2**20):
+    """
+    Reads NAD CSV in blocks of blockSize bytes and returns only rows of state (e.g. 'CT'), all rows if state is None.
+
+    :Returns:
+      Generator of pyarrow RecordBatch
+
+    :Returns Type:
+      generator
+    """
+    reader = pyarrow.csv.open_csv(source, read_options=pyarrow.csv.ReadOptions(block_size=blockSize),
+                                  convert_options=pyarrow.csv.ConvertOptions(column_types=COLUMN_TYPES, include_columns=list(COLUMN_TYPES)))
+    for batch in reader:
+        if state is not None:
+            batch = batch.filter(pc.equal(batch['State'], state))
+        if batch.num_rows > 0:
+            yield batch
+
+
+def fill_zip_codes(addresses, zipAreas = ZIP_AREAS):
+    """
+    Fixes zip codes with zip code areas (ZCTA): fills missing ones, replaces all zip codes of East Hampton
+    (it had only one zip code) and removes zip codes of Rhode Island (028..) that appear in Windham.
+    """
+    layers = load_lookup_layers(zipAreas, None, addresses.crs)
+    pointIdx, polygonIdx = lookup_points(layers, shapely.get_x(addresses.geometry.values), shapely.get_y(addresses.geometry.values))
+    zipCode = np.full(len(addresses), None, dtype=object)
+    # Reversed so that the first matching area of a point is written last
+    zipCode[pointIdx[::-1]] = layers['value'].to_numpy(dtype=object)[polygonIdx[::-1]]
+
+    postcode = addresses['addr:postcode'].to_numpy(dtype=object)
+    replace = pd.isnull(postcode) | (addresses['addr:city'] == 'East Hampton').to_numpy()
+    postcode = np.where(replace, zipCode, postcode)
+    postcode[pd.Series(postcode, dtype=object).str.startswith('028', na=False).to_numpy(dtype=bool)] = None
+    addresses['addr:postcode'] = postcode
+    return addresses
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert NAD address points to OSM address tags")
+    parser.add_argument('--source', default=SOURCE, help="NAD CSV, state extract or the national file")
+    parser.add_argument('--state', default='CT', help="keep only addresses of this state")
+    parser.add_argument('--output', default=OUTPUT)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    parts = []
+    for batch in read_nad(args.source, args.state):
+        parts.append(normalize_batch(batch))
+        print("Normalized " + str(sum(len(part) for part in parts)) + " addresses in " + str(round(time.perf_counter() - start, 2)) + " s")
+    addr = pd.concat(parts, ignore_index=True).pipe(gpd.GeoDataFrame)
+    del parts
+
+    addr = fill_zip_codes(addr)
+    addr.to_file(args.output, driver='GeoJSON')
+    print("Wrote " + str(len(addr)) + " addresses in " + str(round(time.perf_counter() - start, 2)) + " s")
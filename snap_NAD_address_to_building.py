@@ -0,0 +1,205 @@
+# Iterative approach of snapping address points to the nearest building within 100 m radius.
+# Python version of Snap_NAD_address_to_building.R that processes all towns in one run.
+# Towns are snapped independently (same as running the R script for each town) on all CPU cores.
+# One spatial index (STRtree) of buildings is used for each town instead of recalculating nearest building every round.
+# Buildings are read from a local OSM extract instead of Overpass (see osm_extract.py), buildings of each town are cached.
+#
+# Usage: python snap_NAD_address_to_building.py [--town Harwinton] [--workers N]
+
+import geopandas as gpd
+import pandas as pd
+import numpy as np
+import shapely
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from osm_extract import load_buildings, source_key, town_building_index
+from housenumbers import expand_ranges
+
+
+ADDRESS = os.path.expanduser("~/Desktop/Buildings/NAD_address/NAD_r6_TXT/TXT/CT-address.geojson")
+# Local OSM extract of CT (.osm.pbf) or buildings saved as GeoParquet/GeoJSON
+BUILDINGS = os.path.expanduser("~/Desktop/Buildings/OSM/connecticut-latest.osm.pbf")
+OUTDIR = os.path.expanduser("~/Desktop/Buildings/NAD_address/NAD_r6_TXT/TXT")
+
+# Metric CRS for areas and distances: NAD83(2011) / Connecticut
+METRIC_CRS = "EPSG:6433"
+# Garages and sheds are typically < 70 m^2
+MIN_AREA = 70
+# Search radius is increased in steps, so that a building already matched to an address can't get another one
+DISTANCES = list(range(5, 101, 5))
+# Cached town indexes store positions of buildings from prepare_buildings(), change when its filtering
+# or grouping of towns in town_building_index() changes
+BUILDINGS_VERSION = 2
+
+
+def prepare_buildings(buildings, minArea = MIN_AREA):
+    """
+    Fixes invalid geometries and removes small buildings (garages, sheds).
+
+    :Returns:
+      - buildings in METRIC_CRS with column 'centroid'
+
+    :Returns Type:
+      GeoDataFrame
+    """
+    buildings = buildings[['geometry']].to_crs(METRIC_CRS)
+    buildings['geometry'] = buildings.geometry.make_valid()
+    buildings = buildings.loc[buildings.geometry.area > minArea].reset_index(drop=True)
+    buildings['centroid'] = buildings.geometry.centroid
+    return buildings
+
+
+def nearest_remaining(tree, points, remainingBuilds, distance):
+    """
+    Finds for each point the nearest building that is not matched yet, closer than distance.
+
+    :Parameters:
+      - `tree: STRtree of all buildings
+      - `points: array of address points
+      - `remainingBuilds: boolean array, True for buildings that are not matched yet
+      - `distance: maximum distance (exclusive)
+
+    :Returns:
+      - pointIdx, buildIdx, dist: arrays, one row per point that has such building
+
+    :Returns Type:
+      tuple
+    """
+    pointIdx, buildIdx = tree.query(points, predicate='dwithin', distance=distance)
+    keep = remainingBuilds[buildIdx]
+    pointIdx, buildIdx = pointIdx[keep], buildIdx[keep]
+    dist = shapely.distance(points[pointIdx], tree.geometries[buildIdx])
+    keep = dist < distance
+    pointIdx, buildIdx, dist = pointIdx[keep], buildIdx[keep], dist[keep]
+    # Nearest building of each point. Ties are resolved by building position (as st_nearest_feature).
+    order = np.lexsort((buildIdx, dist, pointIdx))
+    first = order[np.r_[True, pointIdx[order][1:] != pointIdx[order][:-1]]] if len(order) else order
+    return pointIdx[first], buildIdx[first], dist[first]
+
+
+def snap_addresses(addresses, buildings, distances = DISTANCES):
+    """
+    Snaps address points to buildings:
+      1) If there are multiple address points in one building => keep those points untouched
+      2) If there is only a single address in one building => move point to centroid
+      3) Match address to the closest building in iteratively increased distance. Each building gets
+         only its closest address, the rest is matched in the next rounds to other buildings.
+      Addresses without building within the largest distance are kept untouched.
+
+    :Parameters:
+      - `addresses: address points in METRIC_CRS
+      - `buildings: buildings from prepare_buildings()
+      - `distances: search distances of rounds in meters
+
+    :Returns:
+      - addresses with snapped geometry in METRIC_CRS
+
+    :Returns Type:
+      GeoDataFrame
+    """
+    addresses = addresses.reset_index(drop=True)
+    points = np.asarray(addresses.geometry.values, dtype=object)
+    geometry = np.array(points, dtype=object)
+    matched = np.zeros(len(addresses), dtype=bool)
+    remainingBuilds = np.ones(len(buildings), dtype=bool)
+    centroids = np.asarray(buildings['centroid'].values, dtype=object)
+    tree = shapely.STRtree(buildings.geometry.values)
+
+    # Match addresses with buildings they are in
+    pointIdx, buildIdx = tree.query(points, predicate='intersects')
+    order = np.lexsort((buildIdx, pointIdx))
+    pointIdx, buildIdx = pointIdx[order], buildIdx[order]
+    nOverlaps = np.bincount(buildIdx, minlength=len(buildings))
+    # Address inside more buildings is matched to the first one
+    first = np.r_[True, pointIdx[1:] != pointIdx[:-1]] if len(pointIdx) else np.zeros(0, dtype=bool)
+    single = first & (nOverlaps[buildIdx] == 1)
+    geometry[pointIdx[single]] = centroids[buildIdx[single]]
+    matched[pointIdx] = True
+    remainingBuilds[buildIdx] = False
+
+    # Match address to the closest building
+    for distance in distances:
+        remaining = np.flatnonzero(~matched)
+        if len(remaining) == 0 or not remainingBuilds.any():
+            break
+        pointIdx, buildIdx, dist = nearest_remaining(tree, points[remaining], remainingBuilds, distance)
+        pointIdx = remaining[pointIdx]
+        # To a building, assign only the closest address (keep the rest for the next round of matching)
+        closest = dist == pd.Series(dist).groupby(buildIdx).transform('min').values
+        pointIdx, buildIdx = pointIdx[closest], buildIdx[closest]
+        geometry[pointIdx] = centroids[buildIdx]
+        matched[pointIdx] = True
+        remainingBuilds[buildIdx] = False
+
+    addresses = addresses.set_geometry(gpd.GeoSeries(geometry, crs=addresses.crs, index=addresses.index))
+    return addresses
+
+
+def snap_town(town, addresses, buildings):
+    """
+    Worker function. Snaps addresses of one town.
+    """
+    start = time.perf_counter()
+    snapped = snap_addresses(addresses, buildings)
+    print((town or "Without town") + ": " + str(len(addresses)) + " addresses, " + str(len(buildings)) + " buildings in " + str(round(time.perf_counter() - start, 2)) + " s")
+    return snapped
+
+
+def snap_by_town(addresses, buildings, workers = None, index = None, margin = max(DISTANCES)):
+    """
+    Snaps addresses of every town (addr:city) independently on a process pool. Buildings of a town are
+    taken from index (see osm_extract.town_building_index), by default they are selected from one spatial index
+    of all buildings by bounding box of town addresses extended by margin.
+    Addresses without addr:city are snapped together as one more town, so no address is dropped.
+
+    :Returns:
+      - snapped addresses of all towns in METRIC_CRS
+
+    :Returns Type:
+      GeoDataFrame
+    """
+    if index is None:
+        tree = shapely.STRtree(buildings.geometry.values)
+    else:
+        townBuildings = dict(tuple(index.groupby('town')['building']))
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = []
+        for town, townAddresses in addresses.groupby(addresses['addr:city'].fillna(''), sort=True):
+            if index is None:
+                area = shapely.buffer(shapely.box(*townAddresses.total_bounds), margin)
+                rows = np.sort(tree.query(area))
+            else:
+                # Town without any OSM building yet is not in the index
+                rows = townBuildings[town].values if town in townBuildings else np.array([], dtype=int)
+            futures.append(pool.submit(snap_town, town, townAddresses, buildings.iloc[rows]))
+        snapped = [future.result() for future in futures]
+    return pd.concat(snapped, ignore_index=True).pipe(gpd.GeoDataFrame)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Snap NAD address points to OSM buildings")
+    parser.add_argument('--town', default=None, help="snap only one town (addr:city)")
+    parser.add_argument('--workers', type=int, default=None, help="number of processes (default: all CPU cores)")
+    args = parser.parse_args()
+
+    addrnodes = gpd.read_file(ADDRESS)
+    if args.town is not None:
+        addrnodes = addrnodes.loc[addrnodes['addr:city'] == args.town]
+    addrnodes = addrnodes.to_crs(METRIC_CRS)
+
+    build = prepare_buildings(load_buildings(BUILDINGS))
+    # Buildings of each town are found once and cached for next runs with the same sources
+    index = town_building_index(addrnodes, build, source_key(ADDRESS, BUILDINGS) + '-v' + str(BUILDINGS_VERSION) + '-' + str(MIN_AREA) + '-' + str(args.town))
+
+    addr_final = snap_by_town(addrnodes, build, args.workers, index).to_crs("EPSG:4326")
+
+    # Turn house numbers like "257 -59" into "257;259"
+    addr_final['addr:housenumber'] = expand_ranges(addr_final['addr:housenumber'])
+
+    # Remove duplicates
+    addr_final = addr_final.drop_duplicates()
+
+    name = "CT-address-IterSnapped.geojson" if args.town is None else "CT-address-" + args.town + "-IterSnapped.geojson"
+    addr_final.to_file(os.path.join(OUTDIR, name), driver='GeoJSON')
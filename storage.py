@@ -0,0 +1,213 @@
+# Storage of intermediate datasets passed between processing steps
+# Intermediates are stored as GeoParquet by default (much faster to write/read and smaller than GeoJSON).
+# GeoJSON is used only for the final import fragments, which are written directly with to_file().
+# Format can be changed for all scripts with environment variable CT_IMPORT_FORMAT=parquet|geoarrow|geojson
+
+import geopandas as gpd
+import pandas as pd
+import pyarrow.parquet as pq
+import pyogrio
+import pyproj
+import json
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _save_parquet(gdf, path):
+    gdf.to_parquet(path, geometry_encoding='WKB')
+
+
+def _save_geoarrow(gdf, path):
+    gdf.to_parquet(path, geometry_encoding='geoarrow')
+
+
+def _save_geojson(gdf, path):
+    gdf.to_file(path, driver='GeoJSON')
+
+
+def _load_parquet(path):
+    # Memory-mapped, so file pages are shared with OS cache instead of copied into read buffers
+    return gpd.read_parquet(path, memory_map=True)
+
+
+# name: (file extension, save function, load function)
+FORMATS = {
+    'parquet': ('.parquet', _save_parquet, _load_parquet),
+    'geoarrow': ('.arrow.parquet', _save_geoarrow, _load_parquet),
+    'geojson': ('.geojson', _save_geojson, gpd.read_file),
+}
+
+FORMAT = os.environ.get('CT_IMPORT_FORMAT', 'parquet')
+
+# Load/save statistics of this process: list of (operation, path, features, seconds, bytes)
+stats = []
+
+
+def stage_path(path, fmt = None):
+    """
+    Returns path of an intermediate file in the given format.
+    Any known extension of path (.geojson, .parquet, ...) is replaced by the extension of the format.
+
+    :Parameters:
+      - `path: path with or without extension, e.g. '/data/ortho/BuildCT_ortho_0.geojson'
+      - `fmt: name of the format in FORMATS. Default: FORMAT
+
+    :Returns Type:
+      str
+    """
+    for extension in sorted((f[0] for f in FORMATS.values()), key=len, reverse=True):
+        if path.endswith(extension):
+            path = path[:-len(extension)]
+            break
+    return path + FORMATS[fmt or FORMAT][0]
+
+
+def _arrow_compatible(gdf):
+    """
+    Parquet columns must have a single type. Object columns with mixed values
+    (e.g. house numbers stored as int and str) are converted to str, as GeoJSON stores them.
+    Converted columns are printed. Mixed int and float values are left to Arrow, which stores them as float.
+    """
+    converted = []
+    for column in gdf.columns:
+        if column == gdf.geometry.name or gdf[column].dtype != object:
+            continue
+        if pd.api.types.infer_dtype(gdf[column], skipna=True) in {'mixed', 'mixed-integer'}:
+            converted.append(column)
+    if len(converted) == 0:
+        return gdf
+    print("Converted columns with mixed types to str: " + ', '.join(converted))
+    gdf = gdf.copy()
+    for column in converted:
+        gdf[column] = gdf[column].where(gdf[column].isnull(), gdf[column].astype(str))
+    return gdf
+
+
+def save_stage(gdf, path, fmt = None):
+    """
+    Saves intermediate dataset and reports time and file size.
+
+    :Returns:
+      - path: path of the written file
+
+    :Returns Type:
+      str
+    """
+    fmt = fmt or FORMAT
+    path = stage_path(path, fmt)
+    if fmt != 'geojson':
+        gdf = _arrow_compatible(gdf)
+    start = time.perf_counter()
+    FORMATS[fmt][1](gdf, path)
+    seconds = time.perf_counter() - start
+    stats.append(('save', path, len(gdf), seconds, os.path.getsize(path)))
+    print("Saved " + path + ": " + str(len(gdf)) + " features in " + str(round(seconds, 2)) + " s, " + str(round(os.path.getsize(path) / 2**20, 1)) + " MB")
+    return path
+
+
+def load_stage(path, fmt = None):
+    """
+    Loads intermediate dataset saved by save_stage() and reports time and file size.
+
+    :Returns Type:
+      GeoDataFrame
+    """
+    fmt = fmt or FORMAT
+    path = stage_path(path, fmt)
+    start = time.perf_counter()
+    gdf = FORMATS[fmt][2](path)
+    seconds = time.perf_counter() - start
+    stats.append(('load', path, len(gdf), seconds, os.path.getsize(path)))
+    print("Loaded " + path + ": " + str(len(gdf)) + " features in " + str(round(seconds, 2)) + " s, " + str(round(os.path.getsize(path) / 2**20, 1)) + " MB")
+    return gdf
+
+
+@functools.lru_cache(maxsize=None)
+def _parse_crs(crs):
+    # Parsing of CRS definition is slow, slices of one dataset share the same definition
+    return pyproj.CRS.from_user_input(json.loads(crs) if crs.startswith('{') else crs)
+
+
+def read_schema(path, fmt = None):
+    """
+    Reads column names and CRS of intermediate dataset without reading its data.
+
+    :Returns:
+      - columns: list of column names including geometry
+      - crs: pyproj CRS or None if file has no CRS
+
+    :Returns Type:
+      tuple
+    """
+    fmt = fmt or FORMAT
+    if fmt == 'geojson':
+        info = pyogrio.read_info(path)
+        return list(info['fields']) + ['geometry'], _parse_crs(info['crs']) if info['crs'] else None
+    schema = pq.read_schema(path)
+    geo = json.loads(schema.metadata[b'geo'])
+    # GeoParquet without crs is in OGC:CRS84 (lon/lat WGS84)
+    crs = geo['columns'][geo['primary_column']].get('crs', 'OGC:CRS84')
+    indexColumns = json.loads(schema.metadata[b'pandas'])['index_columns'] if b'pandas' in schema.metadata else []
+    columns = [c for c in schema.names if c not in indexColumns]
+    return columns, _parse_crs(json.dumps(crs, sort_keys=True) if isinstance(crs, dict) else crs) if crs is not None else None
+
+
+def load_stages(paths, fmt = None, crs = "EPSG:4326", workers = None):
+    """
+    Loads several intermediate datasets with the same columns (e.g. slices of one dataset) and concatenates them once.
+    Columns and CRS of all files are checked before any data are read. Files are read on a thread pool.
+
+    :Parameters:
+      - `paths: list of paths (see stage_path)
+      - `fmt: name of the format in FORMATS. Default: FORMAT
+      - `crs: expected CRS. Files without CRS are assumed to be in it.
+      - `workers: number of threads. Default: number of CPU cores
+
+    :Returns:
+      - gdf: all rows in order of paths with new index
+
+    :Returns Type:
+      GeoDataFrame
+    """
+    fmt = fmt or FORMAT
+    paths = [stage_path(path, fmt) for path in paths]
+    expected = _parse_crs(crs)
+    columns = None
+    for path in paths:
+        pathColumns, pathCrs = read_schema(path, fmt)
+        if columns is None:
+            columns = pathColumns
+        elif pathColumns != columns:
+            raise ValueError(path + " has columns " + str(pathColumns) + ", expected " + str(columns) + " as in " + paths[0])
+        if pathCrs is not None and not pathCrs.equals(expected, ignore_axis_order=True):
+            raise ValueError(path + " has CRS " + pathCrs.to_string() + ", expected " + expected.to_string())
+
+    def load(path):
+        start = time.perf_counter()
+        gdf = FORMATS[fmt][2](path)
+        stats.append(('load', path, len(gdf), time.perf_counter() - start, os.path.getsize(path)))
+        # CRS was checked above and is set once on the result. Without it concat does not compare CRS of every part.
+        return gdf.set_crs(None, allow_override=True)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        parts = list(pool.map(load, paths))
+    gdf = pd.concat(parts, ignore_index=True).pipe(gpd.GeoDataFrame)
+    gdf.crs = crs
+    print("Loaded " + str(len(paths)) + " files: " + str(len(gdf)) + " features in " + str(round(time.perf_counter() - start, 2)) + " s, "
+          + str(round(sum(os.path.getsize(path) for path in paths) / 2**20, 1)) + " MB")
+    return gdf
+
+
+def report_storage():
+    """
+    Prints total load/save times and file sizes of this process.
+    """
+    for operation in ('save', 'load'):
+        rows = [row for row in stats if row[0] == operation]
+        if len(rows) == 0:
+            continue
+        print(operation.title() + ": " + str(len(rows)) + " files, " + str(sum(r[2] for r in rows)) + " features, "
+              + str(round(sum(r[3] for r in rows), 2)) + " s, " + str(round(sum(r[4] for r in rows) / 2**20, 1)) + " MB")
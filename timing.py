@@ -0,0 +1,34 @@
+# Simple wall time collection for profiling of processing steps
+
+import time
+from contextlib import contextmanager
+
+
+@contextmanager
+def timer(timings, name):
+    """
+    Measures wall time of the enclosed block and adds it to timings[name].
+
+    :Parameters:
+      - `timings: dictionary collecting times in seconds. If None, nothing is recorded.
+      - `name: name of the measured step.
+    """
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def report_timings(timings, title = "Timings"):
+    """
+    Prints collected times sorted from the slowest step.
+    """
+    total = sum(timings.values())
+    print(title + " (total " + str(round(total, 3)) + " s)")
+    for name, seconds in sorted(timings.items(), key=lambda x: -x[1]):
+        share = 100 * seconds / total if total > 0 else 0
+        print("  " + name.ljust(24) + str(round(seconds, 3)).rjust(10) + " s" + str(round(share, 1)).rjust(8) + " %")